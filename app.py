@@ -1,29 +1,106 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, stream_with_context, abort, g, has_request_context, request_tearing_down
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms import StringField, PasswordField, SubmitField, SelectField, FloatField, IntegerField, DateField, TextAreaField
-from wtforms.validators import DataRequired, Length, Email
+from wtforms import StringField, PasswordField, SubmitField, SelectField, FloatField, IntegerField, DateField, TextAreaField, BooleanField
+from wtforms.validators import DataRequired, Length, Email, NumberRange, ValidationError
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from datetime import datetime, date
-import pandas as pd
-import openpyxl
-from openpyxl.styles import Font, Alignment, PatternFill
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib import colors
+from datetime import datetime, date, timedelta
 import os
-from sqlalchemy import func, and_, or_
+import sys
+import signal
+import re
+import io
+import csv
+import json
+import uuid
+import time
+import threading
+import multiprocessing
+import click
+import hashlib
+import hmac
+import contextvars
+import zipfile
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from sqlalchemy import func, and_, or_, bindparam, select, event, inspect, text, case, union_all
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.orm import joinedload, contains_eager
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///pos_system.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Database and server settings. Defaults below are overridden by the Python config file
+# named in POS_CONFIG, then by POS_-prefixed environment variables
+# (e.g. POS_DATABASE_URI=postgresql://..., POS_DB_POOL_SIZE=20).
+app.config.update(
+    DATABASE_URI='sqlite:///pos_system.db',
+    # Pooling for server databases (PostgreSQL)
+    DB_POOL_SIZE=10,
+    DB_MAX_OVERFLOW=20,
+    DB_POOL_TIMEOUT=30,
+    DB_POOL_RECYCLE=1800,
+    # Applied to every SQLite connection
+    SQLITE_JOURNAL_MODE='WAL',
+    SQLITE_SYNCHRONOUS='NORMAL',
+    SQLITE_BUSY_TIMEOUT=5000,  # ms to wait for a lock before "database is locked"
+    SQLITE_CACHE_SIZE=-64000,  # negative means KiB, so 64 MB
+    SQLITE_MMAP_SIZE=256 * 1024 * 1024,
+    # Production server (python app.py / flask serve)
+    SERVER_HOST='0.0.0.0',  # listen on the shop network so other tills can connect
+    SERVER_PORT=5000,
+    SERVER_THREADS=16,  # requests handled at once
+    SERVER_CONNECTION_LIMIT=200,
+    SERVER_CHANNEL_TIMEOUT=120,  # seconds before an idle or stalled client is dropped
+    SERVER_SHUTDOWN_TIMEOUT=30,  # seconds to let in-flight requests, then background jobs, finish on shutdown
+    # Per-route request metrics, shown on /metrics to admins
+    METRICS_ENABLED=True,
+    METRICS_TOKEN=None,  # lets a Prometheus scraper in with "Authorization: Bearer <token>"
+    # Query profiler for development and staging: logs repeated and slow queries
+    QUERY_PROFILER=False,
+    QUERY_REPEAT_THRESHOLD=5,  # same statement this many times in one request is flagged
+    SLOW_QUERY_MS=100,  # slower queries are logged with their query plan
+    QUERY_BUDGET_STRICT=False,  # raise QueryBudgetExceeded when a page goes over its budget
+)
+app.config.from_envvar('POS_CONFIG', silent=True)
+app.config.from_prefixed_env('POS')
+
+def database_engine_options(config):
+    # SQLAlchemy engine options for the configured database
+    if config['DATABASE_URI'].startswith('sqlite'):
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+app.config['SQLALCHEMY_DATABASE_URI'] = app.config['DATABASE_URI']
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database_engine_options(app.config)
+
 db = SQLAlchemy(app)
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    # Tune each new SQLite connection for many short concurrent write transactions
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.execute(f"PRAGMA cache_size={int(app.config['SQLITE_CACHE_SIZE'])}")
+    cursor.execute(f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}")
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', apply_sqlite_pragmas)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -92,6 +169,33 @@ class LoadForm(db.Model):
     van = db.relationship('Van', backref='load_forms')
     product = db.relationship('Product', backref='load_forms')
     user = db.relationship('User', backref='load_forms')
+    
+    __table_args__ = (
+        db.Index('ix_load_form_date', 'date', 'id'),
+        db.Index('ix_load_form_van_date', 'van_id', 'date'),
+        db.Index('ix_load_form_product_date', 'product_id', 'date'),
+    )
+
+class LoadTemplate(db.Model):
+    # A saved set of product quantities for pre-filling a bulk load sheet
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    van_id = db.Column(db.Integer, db.ForeignKey('van.id'))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    van = db.relationship('Van', backref='load_templates')
+
+class LoadTemplateItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    template_id = db.Column(db.Integer, db.ForeignKey('load_template.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    
+    # Relationships
+    template = db.relationship('LoadTemplate', backref=db.backref('template_items', cascade='all, delete-orphan'))
+    product = db.relationship('Product')
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -111,6 +215,12 @@ class Sale(db.Model):
     customer = db.relationship('Customer', backref='sales')
     van = db.relationship('Van', backref='sales')
     user = db.relationship('User', backref='sales')
+    
+    __table_args__ = (
+        db.Index('ix_sale_date', 'date', 'id'),
+        db.Index('ix_sale_van_date', 'van_id', 'date'),
+        db.Index('ix_sale_customer_date', 'customer_id', 'date'),
+    )
 
 class SaleItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -124,6 +234,11 @@ class SaleItem(db.Model):
     # Relationships
     sale = db.relationship('Sale', backref='sale_items')
     product = db.relationship('Product', backref='sale_items')
+    
+    __table_args__ = (
+        db.Index('ix_sale_item_sale', 'sale_id'),
+        db.Index('ix_sale_item_product', 'product_id'),
+    )
 
 class Purchase(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -169,6 +284,11 @@ class Return(db.Model):
     customer = db.relationship('Customer', backref='returns')
     van = db.relationship('Van', backref='returns')
     user = db.relationship('User', backref='returns')
+    
+    __table_args__ = (
+        db.Index('ix_return_date', 'date', 'id'),
+        db.Index('ix_return_sale', 'sale_id'),
+    )
 
 class ReturnItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -182,8 +302,84 @@ class ReturnItem(db.Model):
     # Relationships
     return_obj = db.relationship('Return', backref='return_items')
     product = db.relationship('Product', backref='return_items')
+    
+    __table_args__ = (
+        db.Index('ix_return_item_return', 'return_id', 'product_id'),
+    )
+
+class SchemaVersion(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200))
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DailySalesRollup(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    van_id = db.Column(db.Integer, primary_key=True)  # 0 for sales without a van
+    payment_method = db.Column(db.String(20), primary_key=True)
+    gross_amount = db.Column(db.Float, default=0)
+    gst_amount = db.Column(db.Float, default=0)
+    discount_amount = db.Column(db.Float, default=0)
+    final_amount = db.Column(db.Float, default=0)
+    returns_amount = db.Column(db.Float, default=0)
+    order_count = db.Column(db.Integer, default=0)
+
+class StockMovement(db.Model):
+    # Append-only ledger: every change to Product.stock_quantity adds one row
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)  # signed, positive into stock
+    kind = db.Column(db.String(20), nullable=False)  # sale, return, load_in, load_out, opening, import, adjustment
+    source_id = db.Column(db.Integer)  # id of the sale, return or load form behind the movement
+    date = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_stock_movement_date', 'date'),
+        db.Index('ix_stock_movement_product_date', 'product_id', 'date'),
+    )
+
+class StockSnapshot(db.Model):
+    # Stock on hand at the start of ``day`` (the 1st of a month); missing rows mean zero
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+
+class VanStock(db.Model):
+    # What is on board each van right now, kept up to date by loads, van sales and returns
+    van_id = db.Column(db.Integer, db.ForeignKey('van.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    product = db.relationship('Product')
+
+class CatalogueVersion(db.Model):
+    name = db.Column(db.String(20), primary_key=True)  # products, vans, customers
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class DocumentCounter(db.Model):
+    series = db.Column(db.String(100), primary_key=True)  # e.g. invoice|fy=2526|van=V3
+    next_value = db.Column(db.Integer, nullable=False, default=1)
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(20), nullable=False)  # import, export
+    name = db.Column(db.String(50), nullable=False)  # products, sales, ...
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    rows_processed = db.Column(db.Integer, default=0)
+    error_count = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Text, default='[]')  # JSON list of messages
+    result_file = db.Column(db.String(255))
+    download_name = db.Column(db.String(255))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    # Relationships
+    user = db.relationship('User', backref='jobs')
 
 # Forms
+PAYMENT_METHODS = [('cash', 'Cash'), ('card', 'Card')]
+
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
     password = PasswordField('Password', validators=[DataRequired()])
@@ -203,16 +399,29 @@ class ProductForm(FlaskForm):
 class LoadFormForm(FlaskForm):
     form_type = SelectField('Type', choices=[('in', 'Load In'), ('out', 'Load Out')], validators=[DataRequired()])
     van_id = SelectField('Van', coerce=int, validators=[DataRequired()])
-    product_id = SelectField('Product', coerce=int, validators=[DataRequired()])
-    quantity = IntegerField('Quantity', validators=[DataRequired()])
+    product_id = IntegerField('Product', validators=[DataRequired()])
+    quantity = IntegerField('Quantity', validators=[DataRequired(), NumberRange(min=1)])
     date = DateField('Date', default=date.today, validators=[DataRequired()])
     notes = TextAreaField('Notes')
     submit = SubmitField('Submit')
 
+    def validate_product_id(self, field):
+        # Products are picked through the search box, so check the id directly
+        if db.session.get(Product, field.data) is None:
+            raise ValidationError('Select a product from the search results.')
+
+class LoadSheetForm(FlaskForm):
+    form_type = SelectField('Type', choices=[('in', 'Load In'), ('out', 'Load Out')], default='out', validators=[DataRequired()])
+    van_id = SelectField('Van', coerce=int, validators=[DataRequired()])
+    date = DateField('Date', default=date.today, validators=[DataRequired()])
+    notes = TextAreaField('Notes')
+    template_name = StringField('Save as Template', validators=[Length(max=100)])
+    submit = SubmitField('Submit Load Sheet')
+
 class SaleForm(FlaskForm):
     customer_id = SelectField('Customer', coerce=int)
     van_id = SelectField('Van', coerce=int)
-    payment_method = SelectField('Payment Method', choices=[('cash', 'Cash'), ('card', 'Card')], validators=[DataRequired()])
+    payment_method = SelectField('Payment Method', choices=PAYMENT_METHODS, validators=[DataRequired()])
     is_gst_invoice = SelectField('Invoice Type', choices=[('true', 'GST Invoice'), ('false', 'Non-GST Invoice')], validators=[DataRequired()])
     submit = SubmitField('Create Sale')
 
@@ -232,7 +441,7 @@ class VanForm(FlaskForm):
 class ExcelImportForm(FlaskForm):
     file = FileField('Excel File', validators=[
         FileRequired(),
-        FileAllowed(['xlsx', 'xls'], 'Only Excel files are allowed!')
+        FileAllowed(['xlsx', 'xls', 'csv'], 'Only Excel or CSV files are allowed!')
     ])
     import_type = SelectField('Import Type', choices=[
         ('products', 'Products'),
@@ -240,17 +449,822 @@ class ExcelImportForm(FlaskForm):
         ('suppliers', 'Suppliers'),
         ('vans', 'Vans')
     ], validators=[DataRequired()])
+    update_existing = BooleanField('Update price, stock and GST of existing SKUs')
+    run_in_background = BooleanField('Run in background', default=True)
     submit = SubmitField('Import Data')
 
 class ReturnForm(FlaskForm):
-    sale_id = SelectField('Original Sale', coerce=int, validators=[DataRequired()])
+    sale_id = IntegerField('Original Sale', validators=[DataRequired()])
     reason = TextAreaField('Return Reason', validators=[DataRequired()])
     submit = SubmitField('Create Return')
 
+    def validate_sale_id(self, field):
+        # Sales are picked through the lookup box, so check the id directly
+        if db.session.get(Sale, field.data) is None:
+            raise ValidationError('Select a sale from the search results.')
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+def month_range(month):
+    # Half-open [first day, first day of next month) for a 'YYYY-MM' string
+    year, month_num = month.split('-')
+    month_start = date(int(year), int(month_num), 1)
+    return month_start, (month_start + timedelta(days=32)).replace(day=1)
+
+# List pagination helpers
+PAGE_SIZE = 50
+
+def parse_list_filters():
+    # Read the shared date-range, van and customer filters from the query string
+    filters = {'date_from': None, 'date_to': None, 'van_id': None, 'customer_id': None,
+               'payment_method': request.args.get('payment_method') or None}
+    for key in ('date_from', 'date_to'):
+        value = request.args.get(key)
+        if value:
+            try:
+                filters[key] = date.fromisoformat(value)
+            except ValueError:
+                flash(f'Invalid {key.replace("_", " ")}: {value}', 'error')
+    for key in ('van_id', 'customer_id'):
+        filters[key] = request.args.get(key, type=int) or None
+    return filters
+
+def apply_list_filters(query, model, filters):
+    # Filter query on model.date with a half-open range plus van/customer/payment
+    is_datetime = isinstance(model.date.type, db.DateTime)
+    if filters['date_from']:
+        start = filters['date_from']
+        if is_datetime:
+            start = datetime.combine(start, datetime.min.time())
+        query = query.filter(model.date >= start)
+    if filters['date_to']:
+        end = filters['date_to'] + timedelta(days=1)
+        if is_datetime:
+            end = datetime.combine(end, datetime.min.time())
+        query = query.filter(model.date < end)
+    if filters['van_id']:
+        query = query.filter(model.van_id == filters['van_id'])
+    if filters['customer_id'] and hasattr(model, 'customer_id'):
+        query = query.filter(model.customer_id == filters['customer_id'])
+    if filters['payment_method'] and hasattr(model, 'payment_method'):
+        query = query.filter(model.payment_method == filters['payment_method'])
+    return query
+
+def encode_cursor(row):
+    return f"{row.date.isoformat()}_{row.id}"
+
+def decode_cursor(model, cursor):
+    # Turn a <iso date>_<id> cursor back into typed values, or None if malformed
+    try:
+        value, row_id = cursor.rsplit('_', 1)
+        if isinstance(model.date.type, db.DateTime):
+            return datetime.fromisoformat(value), int(row_id)
+        return date.fromisoformat(value), int(row_id)
+    except (ValueError, AttributeError):
+        return None
+
+def keyset_page(query, model, cursor=None, per_page=PAGE_SIZE):
+    # One page of query newest first on (date, id), continuing after the last row shown instead of using OFFSET
+    position = decode_cursor(model, cursor) if cursor else None
+    if position:
+        last_date, last_id = position
+        query = query.filter(or_(
+            model.date < last_date,
+            and_(model.date == last_date, model.id < last_id)
+        ))
+    rows = query.order_by(model.date.desc(), model.id.desc()).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    return {
+        'items': rows,
+        'next_cursor': encode_cursor(rows[-1]) if has_next else None,
+        'is_first': position is None,
+    }
+
+def render_list_page(template, model, query, items_name, with_customer=True):
+    # Shared body of the paginated list views (sales, returns, load forms)
+    filters = parse_list_filters()
+    query = apply_list_filters(query, model, filters)
+    page = keyset_page(query, model, cursor=request.args.get('after'))
+    filter_args = {k: (v.isoformat() if isinstance(v, date) else v)
+                   for k, v in filters.items() if v}
+    return render_template(template,
+                           page=page,
+                           filters=filters,
+                           filter_args=filter_args,
+                           filter_vans=catalogue.get('vans'),
+                           filter_customers=catalogue.get('customers') if with_customer else [],
+                           filter_payment_methods=PAYMENT_METHODS if hasattr(model, 'payment_method') else [],
+                           **{items_name: page['items']})
+
+# Schema migrations
+def add_reporting_indexes(connection):
+    for model in (Sale, SaleItem, Return, ReturnItem, LoadForm):
+        for index in model.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+def seed_catalogue_versions(connection):
+    for name in CATALOGUE_MODELS:
+        bump_catalogue_version(connection, name)
+
+PRODUCT_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(
+        name, sku, category, content='product', content_rowid='id', tokenize='unicode61'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, name, sku, category) VALUES (new.id, new.name, new.sku, new.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, sku, category) VALUES ('delete', old.id, old.name, old.sku, old.category);
+    END""",
+    # Only fires when a searchable column is written, so stock updates skip it
+    """CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE OF name, sku, category ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, sku, category) VALUES ('delete', old.id, old.name, old.sku, old.category);
+        INSERT INTO product_fts(rowid, name, sku, category) VALUES (new.id, new.name, new.sku, new.category);
+    END""",
+    """INSERT INTO product_fts(product_fts) VALUES ('rebuild')""",
+]
+
+def add_product_search_index(connection):
+    # Create the FTS5 product index where SQLite supports it; search falls back to LIKE otherwise
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        connection.exec_driver_sql('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)')
+        connection.exec_driver_sql('DROP TABLE temp.fts5_probe')
+    except OperationalError:
+        app.logger.warning('SQLite was built without FTS5; product search will use LIKE')
+        return
+    for statement in PRODUCT_FTS_DDL:
+        connection.exec_driver_sql(statement)
+
+# (version, description, step) - append only, never renumber
+def start_stock_ledger(connection):
+    # Stock from before the ledger existed becomes one opening movement per product
+    product = Product.__table__
+    connection.execute(StockMovement.__table__.insert().from_select(
+        ['product_id', 'quantity', 'kind', 'date'],
+        select(product.c.id, product.c.stock_quantity, text("'opening'"), bindparam('now', datetime.utcnow()))
+        .where(product.c.stock_quantity != 0)
+    ))
+
+def backfill_van_stock(connection):
+    # Replay loads, van sales and van returns once; anything that nets out negative starts at zero
+    load_form, sale, sale_item = LoadForm.__table__, Sale.__table__, SaleItem.__table__
+    return_, return_item = Return.__table__, ReturnItem.__table__
+    movements = union_all(
+        select(load_form.c.van_id, load_form.c.product_id,
+               case((load_form.c.form_type == 'out', load_form.c.quantity), else_=-load_form.c.quantity).label('quantity')),
+        select(sale.c.van_id, sale_item.c.product_id, -sale_item.c.quantity)
+        .join(sale_item, sale_item.c.sale_id == sale.c.id).where(sale.c.van_id.isnot(None)),
+        select(return_.c.van_id, return_item.c.product_id, return_item.c.quantity)
+        .join(return_item, return_item.c.return_id == return_.c.id).where(return_.c.van_id.isnot(None)),
+    ).subquery()
+    total = func.sum(movements.c.quantity)
+    connection.execute(VanStock.__table__.insert().from_select(
+        ['van_id', 'product_id', 'quantity'],
+        select(movements.c.van_id, movements.c.product_id, total)
+        .group_by(movements.c.van_id, movements.c.product_id).having(total > 0)
+    ))
+
+MIGRATIONS = [
+    (1, 'Add reporting indexes on sales, returns and load forms', add_reporting_indexes),
+    (2, 'Seed catalogue cache versions', seed_catalogue_versions),
+    (3, 'Add FTS5 product search index', add_product_search_index),
+    (4, 'Record opening stock in the stock ledger', start_stock_ledger),
+    (5, 'Backfill on-board van stock', backfill_van_stock),
+]
+
+def run_migrations():
+    # Apply every migration newer than the version recorded in the database
+    SchemaVersion.__table__.create(db.engine, checkfirst=True)
+    current = db.session.query(func.max(SchemaVersion.version)).scalar() or 0
+    db.session.commit()
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        with db.engine.begin() as connection:
+            step(connection)
+            connection.execute(SchemaVersion.__table__.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+        app.logger.info('Applied migration %s: %s', version, description)
+
+def report_queries():
+    # Representative report/list queries whose plans must use an index
+    today = date.today()
+    month_start, next_month = month_range(today.strftime('%Y-%m'))
+    start = datetime.combine(today, datetime.min.time())
+    return {
+        'sales page': Sale.query.filter(Sale.date < start).order_by(Sale.date.desc(), Sale.id.desc()).limit(PAGE_SIZE),
+        'sales by van': Sale.query.filter(Sale.van_id == 1, Sale.date >= start),
+        'sales by customer': Sale.query.filter(Sale.customer_id == 1, Sale.date >= start),
+        'returns page': Return.query.filter(Return.date < start).order_by(Return.date.desc(), Return.id.desc()).limit(PAGE_SIZE),
+        'load forms page': LoadForm.query.filter(LoadForm.date < today).order_by(LoadForm.date.desc(), LoadForm.id.desc()).limit(PAGE_SIZE),
+        'load forms by van': LoadForm.query.filter(LoadForm.van_id == 1, LoadForm.date >= month_start),
+        'stock snapshot lookup': db.session.query(func.max(StockSnapshot.day)).filter(StockSnapshot.day <= month_start),
+        'opening stock': db.session.query(StockSnapshot.product_id, StockSnapshot.quantity).filter(
+            StockSnapshot.day == month_start),
+        'monthly stock report': monthly_movement_totals(month_start, next_month),
+        'monthly van stock report': monthly_van_stock_query(month_start, next_month),
+        'invoice items': SaleItem.query.filter(SaleItem.sale_id == 1),
+        'product sales': SaleItem.query.filter(SaleItem.product_id == 1),
+        'return items': ReturnItem.query.filter(ReturnItem.return_id == 1),
+        'returns of sale': Return.query.filter(Return.sale_id == 1),
+        'dashboard today': db.session.query(func.sum(DailySalesRollup.final_amount)).filter(DailySalesRollup.day == today),
+        'stock ledger slice': db.session.query(StockMovement.product_id, func.sum(StockMovement.quantity)).filter(
+            StockMovement.date >= month_start, StockMovement.date < start).group_by(StockMovement.product_id),
+        'van sales monthly': db.session.query(func.sum(DailySalesRollup.final_amount)).filter(
+            DailySalesRollup.day >= month_start, DailySalesRollup.day < next_month),
+    }
+
+def unindexed_report_queries():
+    # Run EXPLAIN QUERY PLAN over report_queries() and return the ones that scan a table
+    failures = {}
+    for name, query in report_queries().items():
+        sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+        if any(step.startswith('SCAN') and 'USING' not in step for step in plan):
+            failures[name] = plan
+    return failures
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any report query's SQLite plan does a full table scan."""
+    if db.engine.dialect.name != 'sqlite':
+        print('Query plan check only supports SQLite')
+        return
+    failures = unindexed_report_queries()
+    for name, plan in failures.items():
+        print(f'{name}: ' + ' | '.join(plan))
+    if failures:
+        raise SystemExit(1)
+    print(f'All {len(report_queries())} report queries use an index')
+
+# Daily sales rollups
+ROLLUP_SALE_FIELDS = {
+    'gross_amount': 'total_amount',
+    'gst_amount': 'gst_amount',
+    'discount_amount': 'discount_amount',
+    'final_amount': 'final_amount',
+}
+
+def add_to_rollup(connection, key, deltas):
+    # Add deltas to the rollup row for key (day, van_id, payment_method), creating it if needed
+    deltas = {column: value for column, value in deltas.items() if value}
+    if not deltas:
+        return
+    table = DailySalesRollup.__table__
+    day, van_id, payment_method = key
+    row = {column.name: 0 for column in table.columns}
+    row.update(deltas, day=day, van_id=van_id, payment_method=payment_method)
+    # One upsert, so two first sales in the same bucket cannot both try to insert it
+    insert = pg_insert if connection.dialect.name == 'postgresql' else sqlite_insert
+    connection.execute(insert(table).values(**row).on_conflict_do_update(
+        index_elements=[table.c.day, table.c.van_id, table.c.payment_method],
+        set_={column: table.c[column] + value for column, value in deltas.items()}
+    ))
+
+ROLLUP_ATTRIBUTES = {
+    'Sale': ['date', 'van_id', 'payment_method'] + list(ROLLUP_SALE_FIELDS.values()),
+    'Return': ['date', 'van_id', 'sale_id', 'final_amount'],
+}
+
+def stored_values(obj, names):
+    # Values of names as last flushed; attributes assigned while expired are read back from the row
+    state = inspect(obj)
+    values = {}
+    for name in names:
+        history = state.attrs[name].history
+        if history.deleted:
+            values[name] = history.deleted[0]
+        elif history.unchanged:
+            values[name] = history.unchanged[0]
+        elif not history.added:
+            values[name] = getattr(obj, name)
+    missing = [name for name in names if name not in values]
+    if missing:
+        table = type(obj).__table__
+        row = db.session.connection().execute(
+            select(*[table.c[name] for name in missing]).where(table.c.id == obj.id)
+        ).one()
+        values.update(zip(missing, row))
+    return values
+
+def rollup_contribution(obj, before=False):
+    # The (key, amounts) a Sale or Return adds to the rollup, now or as last flushed
+    names = ROLLUP_ATTRIBUTES[type(obj).__name__]
+    values = stored_values(obj, names) if before else {name: getattr(obj, name) for name in names}
+    if isinstance(obj, Sale):
+        key = (values['date'].date(), values['van_id'] or 0, values['payment_method'] or 'cash')
+        amounts = {column: values[field] or 0 for column, field in ROLLUP_SALE_FIELDS.items()}
+        amounts['order_count'] = 1
+    else:
+        sale = db.session.get(Sale, values['sale_id'])
+        key = (values['date'].date(), values['van_id'] or 0, sale.payment_method or 'cash')
+        amounts = {'returns_amount': values['final_amount'] or 0}
+    return key, amounts
+
+@event.listens_for(db.session, 'before_flush')
+def update_sales_rollups(session, flush_context, instances):
+    # Keep DailySalesRollup in step with Sale/Return writes, inside the same transaction
+    connection = None
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, (Sale, Return)):
+            continue
+        if obj in session.new:
+            if obj.date is None:
+                obj.date = datetime.utcnow()
+            changes = [(1, obj)]
+        elif obj in session.deleted:
+            changes = [(-1, obj)]
+        elif session.is_modified(obj):
+            changes = [(-1, obj), (1, obj)]
+        else:
+            continue
+        connection = connection or session.connection()
+        for sign, item in changes:
+            key, amounts = rollup_contribution(item, before=(sign < 0))
+            add_to_rollup(connection, key, {column: sign * amount for column, amount in amounts.items()})
+
+def rebuild_sales_rollups():
+    # Recompute every DailySalesRollup row from the Sale and Return tables
+    rows = {}
+    def bucket(key):
+        return rows.setdefault(key, {column.name: 0 for column in DailySalesRollup.__table__.columns})
+    
+    sale_day = func.date(Sale.date)
+    for day, van_id, method, gross, gst, discount, final, orders in db.session.query(
+        sale_day, func.coalesce(Sale.van_id, 0), func.coalesce(Sale.payment_method, 'cash'),
+        func.sum(Sale.total_amount), func.sum(Sale.gst_amount), func.sum(Sale.discount_amount),
+        func.sum(Sale.final_amount), func.count(Sale.id)
+    ).group_by(sale_day, Sale.van_id, Sale.payment_method):
+        row = bucket((day, van_id, method))
+        row.update(gross_amount=gross or 0, gst_amount=gst or 0, discount_amount=discount or 0,
+                   final_amount=final or 0, order_count=orders)
+    
+    return_day = func.date(Return.date)
+    for day, van_id, method, returned in db.session.query(
+        return_day, func.coalesce(Return.van_id, 0), func.coalesce(Sale.payment_method, 'cash'),
+        func.sum(Return.final_amount)
+    ).join(Sale, Return.sale_id == Sale.id).group_by(return_day, Return.van_id, Sale.payment_method):
+        bucket((day, van_id, method))['returns_amount'] += returned or 0
+    
+    DailySalesRollup.query.delete()
+    records = []
+    for (day, van_id, method), row in rows.items():
+        row.update(day=day if isinstance(day, date) else date.fromisoformat(day), van_id=van_id, payment_method=method)
+        records.append(row)
+    db.session.bulk_insert_mappings(DailySalesRollup, records)
+    db.session.commit()
+    return len(records)
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Rebuild the daily sales rollup table from sales and returns."""
+    print(f'Rebuilt {rebuild_sales_rollups()} rollup rows')
+
+# Document numbers
+app.config.setdefault('DOCUMENT_NUMBER_FORMATS', {
+    'invoice': 'INV-{fy}-{van}-{seq:06d}',
+    'return': 'RET-{fy}-{van}-{seq:06d}',
+})
+app.config.setdefault('DOCUMENT_NUMBER_BLOCK_SIZE', 20)
+app.config.setdefault('FINANCIAL_YEAR_START_MONTH', 4)  # April
+
+def financial_year(day):
+    # Short financial year label, e.g. '2526' for April 2025 - March 2026
+    start_month = app.config['FINANCIAL_YEAR_START_MONTH']
+    if start_month == 1:
+        return str(day.year)
+    start = day.year if day.month >= start_month else day.year - 1
+    return f"{start % 100:02d}{(start + 1) % 100:02d}"
+
+class DocumentNumberAllocator:
+    # Hands out numbers from blocks reserved in DocumentCounter; a block left over at exit is skipped, never reused
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+    
+    def next_value(self, series):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked worker: blocks reserved by the parent are not ours
+                self._blocks = {}
+                self._pid = os.getpid()
+            current, end = self._blocks.get(series, (0, 0))
+            if current >= end:
+                current, end = self._reserve_block(series)
+            self._blocks[series] = (current + 1, end)
+            return current
+    
+    def _reserve_block(self, series):
+        table = DocumentCounter.__table__
+        for attempt in range(STOCK_RETRY_ATTEMPTS):
+            try:
+                with db.engine.begin() as conn:
+                    updated = conn.execute(table.update().where(table.c.series == series).values(
+                        next_value=table.c.next_value + self.block_size
+                    )).rowcount
+                    if updated:
+                        end = conn.execute(select(table.c.next_value).where(table.c.series == series)).scalar()
+                    else:
+                        end = 1 + self.block_size
+                        conn.execute(table.insert().values(series=series, next_value=end))
+                return end - self.block_size, end
+            except IntegrityError:
+                continue  # another worker created the series row first
+            except OperationalError as e:
+                if 'locked' not in str(e) or attempt == STOCK_RETRY_ATTEMPTS - 1:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+        raise RuntimeError(f'Could not reserve document numbers for {series}')
+
+document_numbers = DocumentNumberAllocator(app.config['DOCUMENT_NUMBER_BLOCK_SIZE'])
+
+def next_document_number(doc_type, van_id=None, day=None):
+    # Next number for doc_type ('invoice' or 'return'); series restart per van/year only if the format uses {van}/{fy}
+    fmt = app.config['DOCUMENT_NUMBER_FORMATS'][doc_type]
+    fields = {'fy': financial_year(day or date.today()), 'van': f'V{van_id}' if van_id else 'GEN'}
+    series = '|'.join([doc_type] + [f'{key}={value}' for key, value in fields.items() if '{' + key in fmt])
+    return fmt.format(seq=document_numbers.next_value(series), **fields)
+
+# Catalogue cache
+CatalogueProduct = namedtuple('CatalogueProduct', 'id name sku category selling_price gst_rate')
+CatalogueVan = namedtuple('CatalogueVan', 'id name')
+CatalogueCustomer = namedtuple('CatalogueCustomer', 'id name')
+
+CATALOGUE_MODELS = {'products': Product, 'vans': Van, 'customers': Customer}
+
+def bump_catalogue_version(connection, name):
+    # Invalidate every process's snapshot of catalogue name
+    table = CatalogueVersion.__table__
+    if not connection.execute(table.update().where(table.c.name == name).values(version=table.c.version + 1)).rowcount:
+        connection.execute(table.insert().values(name=name, version=1))
+
+@event.listens_for(db.session, 'before_flush')
+def bump_changed_catalogues(session, flush_context, instances):
+    changed = {name for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+               for name, model in CATALOGUE_MODELS.items() if isinstance(obj, model)}
+    for name in sorted(changed):
+        bump_catalogue_version(session.connection(), name)
+
+class CatalogueCache:
+    # Per-process dropdown snapshots, reused for as long as their CatalogueVersion row is unchanged
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = threading.Lock()
+    
+    def current_versions(self):
+        if has_request_context() and 'catalogue_versions' in g:
+            return g.catalogue_versions
+        versions = dict(db.session.query(CatalogueVersion.name, CatalogueVersion.version))
+        if has_request_context():
+            g.catalogue_versions = versions
+        return versions
+    
+    def get(self, name):
+        version = self.current_versions().get(name, 0)
+        cached = self._snapshots.get(name)
+        if cached and cached[0] == version:
+            return cached[1]
+        with self._lock:
+            data = getattr(self, f'load_{name}')()
+            self._snapshots[name] = (version, data)
+        return data
+    
+    def load_products(self):
+        return tuple(CatalogueProduct(*row) for row in db.session.query(
+            Product.id, Product.name, Product.sku, Product.category, Product.selling_price, Product.gst_rate
+        ).order_by(Product.name))
+    
+    def load_vans(self):
+        return tuple(CatalogueVan(*row) for row in db.session.query(Van.id, Van.name).order_by(Van.name))
+    
+    def load_customers(self):
+        return tuple(CatalogueCustomer(*row) for row in db.session.query(Customer.id, Customer.name).order_by(Customer.name))
+
+catalogue = CatalogueCache()
+
+# Stock movements
+STOCK_RETRY_ATTEMPTS = 5
+
+class InsufficientStockError(Exception):
+    # A conditional stock decrement could not be applied to every line
+    def __init__(self, shortfalls):
+        super().__init__('Insufficient stock')
+        self.shortfalls = shortfalls  # [{'product_id', 'requested', 'available'}]
+
+def execute_stock_update(stmt, params):
+    # Run stmt for every param set and return the rows changed, in one executemany where rowcounts allow
+    if db.session.get_bind().dialect.supports_sane_multi_rowcount:
+        return db.session.execute(stmt, params).rowcount
+    return sum(db.session.execute(stmt, p).rowcount for p in params)
+
+def record_stock_movements(quantities, kind, source_id=None):
+    # Append signed {product_id: quantity} changes to the ledger; source_id may be a {product_id: id} mapping
+    now = datetime.utcnow()
+    rows = [{'product_id': pid, 'quantity': qty, 'kind': kind, 'date': now,
+             'source_id': source_id.get(pid) if isinstance(source_id, dict) else source_id}
+            for pid, qty in quantities.items() if qty]
+    if rows:
+        db.session.execute(StockMovement.__table__.insert(), rows)
+
+def check_stock_quantities(quantities):
+    # The direction comes from the caller, so a zero or negative amount is always a bug
+    bad = [pid for pid, qty in quantities.items() if qty <= 0]
+    if bad:
+        raise ValueError(f'Stock quantities must be positive (products {bad})')
+
+def reserve_stock(quantities, kind, source_id=None):
+    # Take {product_id: quantity} out of stock with conditional UPDATEs; raises InsufficientStockError if short
+    check_stock_quantities(quantities)
+    table = Product.__table__
+    stmt = table.update().where(
+        table.c.id == bindparam('pid'),
+        table.c.stock_quantity >= bindparam('qty')
+    ).values(stock_quantity=table.c.stock_quantity - bindparam('qty'), updated_at=datetime.utcnow())
+    params = [{'pid': pid, 'qty': qty} for pid, qty in quantities.items()]
+    if execute_stock_update(stmt, params) == len(params):
+        record_stock_movements({pid: -qty for pid, qty in quantities.items()}, kind, source_id)
+        return
+    
+    db.session.rollback()
+    available = dict(db.session.query(Product.id, Product.stock_quantity).filter(Product.id.in_(quantities)))
+    raise InsufficientStockError([
+        {'product_id': pid, 'requested': qty, 'available': available.get(pid, 0)}
+        for pid, qty in quantities.items() if available.get(pid, 0) < qty
+    ])
+
+def release_stock(quantities, kind, source_id=None):
+    # Atomically put {product_id: quantity} back into stock and record the movements
+    check_stock_quantities(quantities)
+    table = Product.__table__
+    stmt = table.update().where(table.c.id == bindparam('pid')).values(
+        stock_quantity=table.c.stock_quantity + bindparam('qty'), updated_at=datetime.utcnow()
+    )
+    execute_stock_update(stmt, [{'pid': pid, 'qty': qty} for pid, qty in quantities.items()])
+    record_stock_movements(quantities, kind, source_id)
+
+def run_in_transaction(fn, *args, **kwargs):
+    # Call fn and commit, retrying while SQLite is busy; fn must rebuild its session state on every attempt
+    for attempt in range(STOCK_RETRY_ATTEMPTS):
+        try:
+            result = fn(*args, **kwargs)
+            db.session.commit()
+            return result
+        except OperationalError as e:
+            db.session.rollback()
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            if attempt == STOCK_RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+# Van stock
+app.config.setdefault('ENFORCE_VAN_STOCK', True)  # False lets van sales take van stock negative instead of blocking
+
+class InsufficientVanStockError(InsufficientStockError):
+    # A van sale asked for more than is on board
+    def __init__(self, shortfalls):
+        super().__init__(shortfalls)
+        self.args = ('Insufficient stock on van',)
+
+def ensure_van_stock_rows(van_id, product_ids):
+    # Insert zero VanStock rows for products the van has never carried
+    rows = [{'van_id': van_id, 'product_id': pid, 'quantity': 0} for pid in product_ids]
+    if db.session.get_bind().dialect.name == 'postgresql':
+        stmt = pg_insert(VanStock.__table__).on_conflict_do_nothing()
+    else:
+        stmt = VanStock.__table__.insert().prefix_with('OR IGNORE', dialect='sqlite')
+    db.session.execute(stmt, rows)
+
+def add_van_stock(van_id, quantities):
+    # Put {product_id: quantity} on board a van, in the caller's transaction
+    check_stock_quantities(quantities)
+    ensure_van_stock_rows(van_id, quantities)
+    table = VanStock.__table__
+    stmt = table.update().where(table.c.van_id == van_id, table.c.product_id == bindparam('pid')).values(
+        quantity=table.c.quantity + bindparam('qty'), updated_at=datetime.utcnow()
+    )
+    execute_stock_update(stmt, [{'pid': pid, 'qty': qty} for pid, qty in quantities.items()])
+
+def take_van_stock(van_id, quantities):
+    # Take {product_id: quantity} off a van with conditional UPDATEs; raises InsufficientVanStockError if short
+    check_stock_quantities(quantities)
+    table = VanStock.__table__
+    conditions = [table.c.van_id == van_id, table.c.product_id == bindparam('pid')]
+    if app.config['ENFORCE_VAN_STOCK']:
+        conditions.append(table.c.quantity >= bindparam('qty'))
+    else:
+        ensure_van_stock_rows(van_id, quantities)
+    stmt = table.update().where(*conditions).values(
+        quantity=table.c.quantity - bindparam('qty'), updated_at=datetime.utcnow()
+    )
+    params = [{'pid': pid, 'qty': qty} for pid, qty in quantities.items()]
+    if execute_stock_update(stmt, params) == len(params):
+        return
+    
+    db.session.rollback()
+    on_board = dict(db.session.query(VanStock.product_id, VanStock.quantity).filter(
+        VanStock.van_id == van_id, VanStock.product_id.in_(quantities)
+    ))
+    raise InsufficientVanStockError([
+        {'product_id': pid, 'van_id': van_id, 'requested': qty, 'available': on_board.get(pid, 0)}
+        for pid, qty in quantities.items() if on_board.get(pid, 0) < qty
+    ])
+
+def unload_van_stock(van_id, quantities):
+    # Take a Load In off a van, stopping at zero: Load In also receives new stock, so it never blocks
+    check_stock_quantities(quantities)
+    ensure_van_stock_rows(van_id, quantities)
+    table = VanStock.__table__
+    stmt = table.update().where(table.c.van_id == van_id, table.c.product_id == bindparam('pid')).values(
+        quantity=case((table.c.quantity > bindparam('qty'), table.c.quantity - bindparam('qty')), else_=0),
+        updated_at=datetime.utcnow()
+    )
+    execute_stock_update(stmt, [{'pid': pid, 'qty': qty} for pid, qty in quantities.items()])
+
+# Stock ledger
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+def next_month_start(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+def stock_levels_on(day, product_ids=None):
+    # {product_id: quantity} at the start of day, from the nearest snapshot plus or minus the movements in between
+    before = db.session.query(func.max(StockSnapshot.day)).filter(StockSnapshot.day <= day).scalar()
+    after = None if before else db.session.query(func.min(StockSnapshot.day)).filter(StockSnapshot.day > day).scalar()
+    target = datetime.combine(day, datetime.min.time())
+    movements = db.session.query(StockMovement.product_id, func.sum(StockMovement.quantity))
+    if before or after:
+        base_id, base_quantity = StockSnapshot.product_id, StockSnapshot.quantity
+        base = db.session.query(base_id, base_quantity).filter(StockSnapshot.day == (before or after))
+    else:
+        base_id, base_quantity = Product.id, Product.stock_quantity
+        base = db.session.query(base_id, base_quantity)
+    if before:
+        movements = movements.filter(StockMovement.date >= datetime.combine(before, datetime.min.time()),
+                                     StockMovement.date < target)
+        sign = 1
+    else:
+        if after:
+            movements = movements.filter(StockMovement.date < datetime.combine(after, datetime.min.time()))
+        movements = movements.filter(StockMovement.date >= target)
+        sign = -1
+    if product_ids is not None:
+        base = base.filter(base_id.in_(product_ids))
+        movements = movements.filter(StockMovement.product_id.in_(product_ids))
+    
+    levels = {pid: quantity or 0 for pid, quantity in base}
+    for pid, quantity in movements.group_by(StockMovement.product_id):
+        levels[pid] = levels.get(pid, 0) + sign * quantity
+    return {pid: quantity for pid, quantity in levels.items() if quantity}
+
+def take_stock_snapshots(until=None):
+    # Snapshot every missing month start before until (today in UTC, the clock the ledger is stamped with)
+    until = until or datetime.utcnow().date()
+    last = db.session.query(func.max(StockSnapshot.day)).scalar()
+    if last:
+        day = next_month_start(last)
+    else:
+        first = db.session.query(func.min(StockMovement.date)).scalar()
+        if first is None:
+            return []
+        day = next_month_start(first.date())
+    
+    written = []
+    while day < until:
+        levels = stock_levels_on(day)
+        # A month where nothing is in stock has no rows, and is simply rebuilt next time
+        if levels:
+            db.session.execute(StockSnapshot.__table__.insert(), [
+                {'day': day, 'product_id': pid, 'quantity': quantity} for pid, quantity in levels.items()
+            ])
+            db.session.commit()
+            written.append(day)
+        day = next_month_start(day)
+    return written
+
+def stock_ledger_differences():
+    # {product_id: stock - ledger total} for products whose ledger does not add up
+    ledger = dict(db.session.query(StockMovement.product_id, func.sum(StockMovement.quantity))
+                  .group_by(StockMovement.product_id))
+    differences = {pid: (stock or 0) - (ledger.get(pid) or 0)
+                   for pid, stock in db.session.query(Product.id, Product.stock_quantity)}
+    return {pid: difference for pid, difference in differences.items() if difference}
+
+@app.cli.command('snapshot-stock')
+def snapshot_stock_command():
+    """Write any missing monthly stock snapshots; run daily or on the 2nd of each month."""
+    days = take_stock_snapshots()
+    print(f"Wrote snapshots for {', '.join(map(str, days))}" if days else 'Stock snapshots are up to date')
+
+@app.cli.command('check-stock-ledger')
+@click.option('--fix', is_flag=True, help='Record an adjustment movement for each difference.')
+def check_stock_ledger_command(fix):
+    """Fail if any product's stock differs from the sum of its ledger movements."""
+    differences = stock_ledger_differences()
+    for pid, difference in differences.items():
+        print(f'product {pid}: stock differs from ledger by {difference:+d}')
+    if differences and fix:
+        record_stock_movements(differences, 'adjustment')
+        db.session.commit()
+        print(f'Recorded {len(differences)} adjustment movements')
+    elif differences:
+        raise SystemExit(1)
+    else:
+        print('Stock ledger matches product stock')
+
+# Posted product grids
+def submitted_quantities():
+    # {product_id: quantity} from the posted pairs; blank and zero rows are skipped, other bad pairs raise ValueError
+    quantities = {}
+    # Parse pairs together: getlist(type=int) drops bad ids and would shift every later quantity
+    for product_id, quantity in zip(request.form.getlist('product_id'), request.form.getlist('quantity')):
+        if not quantity.strip():
+            continue
+        product_id, quantity = int(product_id), int(quantity)
+        if quantity < 0:
+            raise ValueError(f'Negative quantity for product {product_id}')
+        if quantity:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+# Returns
+ReturnableLine = namedtuple('ReturnableLine', 'product sold returned remaining unit_price gst_rate')
+
+class ReturnQuantityError(Exception):
+    # A return line asks for more than is still returnable on the original sale
+    def __init__(self, problems):
+        super().__init__('Return exceeds the quantity sold')
+        self.problems = problems  # [{'product_id', 'name', 'requested', 'returnable'}]
+
+def returnable_lines(sale_id):
+    # {product_id: ReturnableLine} for a sale in one query, net of every return against it
+    returned = db.session.query(
+        ReturnItem.product_id, func.sum(ReturnItem.quantity).label('quantity')
+    ).join(Return).filter(Return.sale_id == sale_id).group_by(ReturnItem.product_id).subquery()
+    rows = db.session.query(
+        Product,
+        func.sum(SaleItem.quantity),
+        func.coalesce(returned.c.quantity, 0),
+        func.sum(SaleItem.total_price),
+        func.max(SaleItem.gst_rate)
+    ).join(SaleItem, SaleItem.product_id == Product.id).outerjoin(
+        returned, returned.c.product_id == Product.id
+    ).filter(SaleItem.sale_id == sale_id).group_by(Product.id, returned.c.quantity).order_by(Product.name)
+    return {
+        product.id: ReturnableLine(product, sold, returned_qty, sold - returned_qty, value / sold, gst_rate or 0)
+        for product, sold, returned_qty, value, gst_rate in rows if sold
+    }
+
+def add_return_lines(return_id, quantities):
+    # Add {product_id: quantity} to a return, checking every line against the locked original sale first
+    sale = db.session.execute(select(Sale).where(
+        Sale.id == select(Return.sale_id).where(Return.id == return_id).scalar_subquery()
+    ).with_for_update()).scalar_one()
+    return_obj = db.session.get(Return, return_id, populate_existing=True)
+    lines = returnable_lines(sale.id)
+
+    problems = [
+        {'product_id': pid, 'name': lines[pid].product.name if pid in lines else f'product {pid}',
+         'requested': qty, 'returnable': lines[pid].remaining if pid in lines else 0}
+        for pid, qty in quantities.items() if pid not in lines or qty > lines[pid].remaining
+    ]
+    if problems:
+        db.session.rollback()
+        raise ReturnQuantityError(problems)
+
+    subtotal = gst_amount = 0
+    for pid, qty in quantities.items():
+        line = lines[pid]
+        total_price = line.unit_price * qty
+        db.session.add(ReturnItem(
+            return_id=return_id,
+            product_id=pid,
+            quantity=qty,
+            unit_price=line.unit_price,
+            total_price=total_price,
+            gst_rate=line.gst_rate
+        ))
+        subtotal += total_price
+        if sale.is_gst_invoice:
+            gst_amount += total_price * line.gst_rate / 100
+    # Add back to inventory, and to the van the goods came back on
+    release_stock(quantities, 'return', return_id)
+    if return_obj.van_id:
+        add_van_stock(return_obj.van_id, quantities)
+
+    return_obj.total_amount = (return_obj.total_amount or 0) + subtotal
+    return_obj.gst_amount = (return_obj.gst_amount or 0) + gst_amount
+    return_obj.final_amount = (return_obj.final_amount or 0) + subtotal + gst_amount
+
 # Routes
 @app.route('/')
 @login_required
@@ -258,17 +1272,19 @@ def dashboard():
     # Dashboard statistics
     total_products = Product.query.count()
     low_stock_products = Product.query.filter(Product.stock_quantity <= Product.min_stock_level).count()
-    total_sales_today = db.session.query(func.sum(Sale.final_amount)).filter(
-        func.date(Sale.date) == date.today()
+    total_sales_today = db.session.query(func.sum(DailySalesRollup.final_amount)).filter(
+        DailySalesRollup.day == date.today()
     ).scalar() or 0
     
     recent_sales = Sale.query.order_by(Sale.date.desc()).limit(5).all()
+    slow_routes = metrics_summary(limit=5) if current_user.role == 'admin' else None
     
     return render_template('dashboard.html', 
                          total_products=total_products,
                          low_stock_products=low_stock_products,
                          total_sales_today=total_sales_today,
-                         recent_sales=recent_sales)
+                         recent_sales=recent_sales,
+                         slow_routes=slow_routes)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -363,6 +1379,19 @@ def delete_van(van_id):
     flash('Van deleted successfully!')
     return redirect(url_for('vans'))
 
+@app.route('/vans/<int:van_id>/stock')
+@login_required
+def van_stock(van_id):
+    # What is on board a van now, read straight from VanStock
+    van = Van.query.get_or_404(van_id)
+    items = VanStock.query.join(Product).options(contains_eager(VanStock.product)).filter(
+        VanStock.van_id == van_id, VanStock.quantity != 0
+    ).order_by(Product.sku).all()
+    total_units = sum(item.quantity for item in items)
+    total_value = sum(item.quantity * item.product.selling_price for item in items)
+    return render_template('van_stock.html', van=van, items=items,
+                         total_units=total_units, total_value=total_value)
+
 @app.route('/excel_import', methods=['GET', 'POST'])
 @login_required
 def excel_import():
@@ -370,31 +1399,19 @@ def excel_import():
     
     if form.validate_on_submit():
         try:
-            # Save uploaded file
-            filename = secure_filename(form.file.data.filename)
-            file_path = os.path.join('uploads', filename)
-            os.makedirs('uploads', exist_ok=True)
-            form.file.data.save(file_path)
-            
-            # Read Excel file
-            df = pd.read_excel(file_path)
-            
             import_type = form.import_type.data
-            success_count = 0
-            error_count = 0
-            errors = []
+            if form.run_in_background.data:
+                upload_path = save_job_file(form.file.data)
+                job = submit_job('import', import_type, import_task, import_type, upload_path,
+                                 form.file.data.filename, form.update_existing.data)
+                return redirect(url_for('job_status', job_id=job.id))
             
-            if import_type == 'products':
-                success_count, error_count, errors = import_products(df)
-            elif import_type == 'customers':
-                success_count, error_count, errors = import_customers(df)
-            elif import_type == 'suppliers':
-                success_count, error_count, errors = import_suppliers(df)
-            elif import_type == 'vans':
-                success_count, error_count, errors = import_vans(df)
-            
-            # Clean up uploaded file
-            os.remove(file_path)
+            success_count, error_count, errors = run_import(
+                import_type,
+                form.file.data.stream,
+                form.file.data.filename,
+                update_existing=form.update_existing.data
+            )
             
             if success_count > 0:
                 flash(f'Successfully imported {success_count} {import_type}!', 'success')
@@ -406,9 +1423,8 @@ def excel_import():
             return redirect(url_for('excel_import'))
             
         except Exception as e:
+            db.session.rollback()
             flash(f'Error importing file: {str(e)}', 'error')
-            if 'file_path' in locals() and os.path.exists(file_path):
-                os.remove(file_path)
     
     return render_template('excel_import.html', form=form)
 
@@ -454,31 +1470,34 @@ def download_sample(file_type):
         flash('Invalid file type!', 'error')
         return redirect(url_for('excel_import'))
     
-    df = pd.DataFrame(sample_data)
+    from spreadsheets import write_xlsx
+    output = write_xlsx(list(sample_data), zip(*sample_data.values()), file_type)
     filename = f'sample_{file_type}.xlsx'
-    df.to_excel(filename, index=False)
-    
-    return send_file(filename, as_attachment=True, download_name=filename)
+    return send_file(output, as_attachment=True, download_name=filename,
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
 @app.route('/returns')
 @login_required
 def returns():
-    returns = Return.query.order_by(Return.date.desc()).all()
-    return render_template('returns.html', returns=returns)
+    query = Return.query.options(
+        joinedload(Return.sale),
+        joinedload(Return.customer),
+        joinedload(Return.van)
+    )
+    return render_list_page('returns.html', Return, query, 'returns')
 
 @app.route('/returns/add', methods=['GET', 'POST'])
 @login_required
 def add_return():
     form = ReturnForm()
-    form.sale_id.choices = [(s.id, f"{s.invoice_number} - {s.customer.name if s.customer else 'Walk-in'} ({s.date.strftime('%Y-%m-%d')})") for s in Sale.query.order_by(Sale.date.desc()).all()]
     
     if form.validate_on_submit():
-        # Generate return number
-        return_number = f"RET{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
         # Get original sale details
         original_sale = Sale.query.get(form.sale_id.data)
         
+        # Generate return number
+        return_number = next_document_number('return', van_id=original_sale.van_id)
+        
         return_obj = Return(
             return_number=return_number,
             sale_id=form.sale_id.data,
@@ -496,7 +1515,7 @@ def add_return():
         
         return redirect(url_for('add_return_items', return_id=return_obj.id))
     
-    return render_template('add_return.html', form=form)
+    return render_template('add_return.html', form=form, vans=catalogue.get('vans'))
 
 @app.route('/returns/<int:return_id>/items', methods=['GET', 'POST'])
 @login_required
@@ -505,79 +1524,33 @@ def add_return_items(return_id):
     original_sale = return_obj.sale
     
     if request.method == 'POST':
-        product_id = request.form.get('product_id')
-        quantity = int(request.form.get('quantity'))
-        
-        # Check if this product was in the original sale
-        original_item = SaleItem.query.filter_by(sale_id=original_sale.id, product_id=product_id).first()
-        if not original_item:
-            flash('This product was not in the original sale!', 'error')
-            return redirect(url_for('add_return_items', return_id=return_id))
-        
-        # Check if return quantity doesn't exceed original quantity
-        total_returned = db.session.query(func.sum(ReturnItem.quantity)).filter_by(
-            return_id=return_id, product_id=product_id
-        ).scalar() or 0
-        
-        if total_returned + quantity > original_item.quantity:
-            flash(f'Cannot return more than {original_item.quantity - total_returned} units of this product!', 'error')
-            return redirect(url_for('add_return_items', return_id=return_id))
-        
-        product = Product.query.get(product_id)
-        unit_price = original_item.unit_price
-        total_price = unit_price * quantity
-        
-        return_item = ReturnItem(
-            return_id=return_id,
-            product_id=product_id,
-            quantity=quantity,
-            unit_price=unit_price,
-            total_price=total_price,
-            gst_rate=original_item.gst_rate
-        )
-        
-        # Update product stock (add back to inventory)
-        product.stock_quantity += quantity
-        
-        db.session.add(return_item)
-        db.session.commit()
-        
-        flash('Item added to return successfully!')
-    
-    # Calculate totals
-    return_items = ReturnItem.query.filter_by(return_id=return_id).all()
-    subtotal = sum(item.total_price for item in return_items)
-    gst_amount = sum(item.total_price * item.gst_rate / 100 for item in return_items) if original_sale.is_gst_invoice else 0
-    total_amount = subtotal + gst_amount
-    
-    # Update return totals
-    return_obj.total_amount = subtotal
-    return_obj.gst_amount = gst_amount
-    return_obj.final_amount = total_amount
-    db.session.commit()
+        try:
+            quantities = submitted_quantities()
+        except ValueError:
+            flash('Every quantity must be a whole number!', 'error')
+        else:
+            if not quantities:
+                flash('Enter a quantity for at least one product!', 'error')
+            else:
+                try:
+                    run_in_transaction(add_return_lines, return_id, quantities)
+                    flash(f'{len(quantities)} item(s) added to return successfully!')
+                except ReturnQuantityError as e:
+                    for problem in e.problems:
+                        flash(f"Cannot return {problem['requested']} units of {problem['name']}: "
+                              f"only {problem['returnable']} left to return!", 'error')
+        return redirect(url_for('add_return_items', return_id=return_id))
     
-    # Get products from original sale
-    original_items = SaleItem.query.filter_by(sale_id=original_sale.id).all()
-    available_products = []
-    for item in original_items:
-        total_returned = db.session.query(func.sum(ReturnItem.quantity)).filter_by(
-            return_id=return_id, product_id=item.product_id
-        ).scalar() or 0
-        remaining = item.quantity - total_returned
-        if remaining > 0:
-            available_products.append({
-                'product': item.product,
-                'max_quantity': remaining,
-                'unit_price': item.unit_price
-            })
+    return_items = ReturnItem.query.options(joinedload(ReturnItem.product)).filter_by(return_id=return_id).all()
+    available_products = [line for line in returnable_lines(original_sale.id).values() if line.remaining > 0]
     
     return render_template('add_return_items.html', 
                          return_obj=return_obj,
                          return_items=return_items,
                          available_products=available_products,
-                         subtotal=subtotal,
-                         gst_amount=gst_amount,
-                         total_amount=total_amount)
+                         subtotal=return_obj.total_amount,
+                         gst_amount=return_obj.gst_amount or 0,
+                         total_amount=return_obj.final_amount)
 
 @app.route('/return_receipt/<int:return_id>')
 @login_required
@@ -587,149 +1560,122 @@ def generate_return_receipt(return_id):
     
     return render_template('return_receipt.html', return_obj=return_obj, return_items=return_items)
 
-def import_products(df):
-    success_count = 0
-    error_count = 0
-    errors = []
-    
-    required_columns = ['name', 'sku', 'category', 'cost_price', 'selling_price']
-    
-    for index, row in df.iterrows():
-        try:
-            # Check required columns
-            if not all(col in df.columns for col in required_columns):
-                errors.append(f"Row {index + 2}: Missing required columns. Need: {required_columns}")
-                error_count += 1
-                continue
-            
-            # Check if product already exists
-            existing_product = Product.query.filter_by(sku=row['sku']).first()
-            if existing_product:
-                errors.append(f"Row {index + 2}: Product with SKU '{row['sku']}' already exists")
-                error_count += 1
-                continue
-            
-            product = Product(
-                name=row['name'],
-                sku=row['sku'],
-                category=row['category'],
-                cost_price=float(row['cost_price']),
-                selling_price=float(row['selling_price']),
-                stock_quantity=int(row.get('stock_quantity', 0)),
-                min_stock_level=int(row.get('min_stock_level', 10)),
-                gst_rate=float(row.get('gst_rate', 18.0))
-            )
-            
-            db.session.add(product)
-            success_count += 1
-            
-        except Exception as e:
-            errors.append(f"Row {index + 2}: {str(e)}")
-            error_count += 1
-    
-    if success_count > 0:
+# Import engine
+IMPORT_CHUNK_SIZE = 500
+
+def bulk_insert(model, records, on_chunk=None):
+    # Insert plain dicts in IMPORT_CHUNK_SIZE batches, one transaction each; on_chunk sees each batch before commit
+    catalogue_name = next((name for name, m in CATALOGUE_MODELS.items() if m is model), None)
+    for start in range(0, len(records), IMPORT_CHUNK_SIZE):
+        chunk = records[start:start + IMPORT_CHUNK_SIZE]
+        db.session.bulk_insert_mappings(model, chunk)
+        if on_chunk:
+            on_chunk(chunk)
+        if catalogue_name:
+            bump_catalogue_version(db.session.connection(), catalogue_name)
         db.session.commit()
-    
-    return success_count, error_count, errors
 
-def import_customers(df):
-    success_count = 0
-    error_count = 0
-    errors = []
-    
-    required_columns = ['name']
-    
-    for index, row in df.iterrows():
-        try:
-            if 'name' not in df.columns:
-                errors.append(f"Row {index + 2}: Missing 'name' column")
-                error_count += 1
-                continue
-            
-            customer = Customer(
-                name=row['name'],
-                phone=row.get('phone', ''),
-                email=row.get('email', ''),
-                address=row.get('address', ''),
-                gst_number=row.get('gst_number', '')
-            )
-            
-            db.session.add(customer)
-            success_count += 1
-            
-        except Exception as e:
-            errors.append(f"Row {index + 2}: {str(e)}")
-            error_count += 1
+def record_imported_stock(records):
+    # Ledger the starting stock of newly inserted product records
+    stocked = {record['sku']: record['stock_quantity'] for record in records if record['stock_quantity']}
+    if stocked:
+        ids = db.session.query(Product.sku, Product.id).filter(Product.sku.in_(stocked))
+        record_stock_movements({pid: stocked[sku] for sku, pid in ids}, 'import')
+
+def import_products(df, update_existing=False):
+    text_columns = ['name', 'sku', 'category']
+    numeric_defaults = {
+        'cost_price': None,
+        'selling_price': None,
+        'stock_quantity': 0,
+        'min_stock_level': 10,
+        'gst_rate': 18.0,
+    }
+    required_columns = ['name', 'sku', 'category', 'cost_price', 'selling_price']
+    from spreadsheets import validate_import_frame
+    df, errors = validate_import_frame(df, required_columns, text_columns, numeric_defaults)
+    if df.empty:
+        return 0, len(errors), errors
     
-    if success_count > 0:
-        db.session.commit()
+    duplicated = df['sku'].duplicated()
+    errors += [f"Row {index}: SKU '{sku}' appears more than once in the file" for index, sku in df.loc[duplicated, 'sku'].items()]
+    df = df[~duplicated]
+    df = df.astype({'stock_quantity': int, 'min_stock_level': int})
     
-    return success_count, error_count, errors
-
-def import_suppliers(df):
-    success_count = 0
-    error_count = 0
-    errors = []
+    existing, existing_stock = {}, {}
+    skus = df['sku'].tolist()
+    for start in range(0, len(skus), IMPORT_CHUNK_SIZE):
+        for sku, pid, stock in db.session.query(Product.sku, Product.id, Product.stock_quantity).filter(
+            Product.sku.in_(skus[start:start + IMPORT_CHUNK_SIZE])
+        ):
+            existing[sku] = pid
+            existing_stock[pid] = stock or 0
     
-    for index, row in df.iterrows():
-        try:
-            if 'name' not in df.columns:
-                errors.append(f"Row {index + 2}: Missing 'name' column")
-                error_count += 1
-                continue
-            
-            supplier = Supplier(
-                name=row['name'],
-                contact_person=row.get('contact_person', ''),
-                phone=row.get('phone', ''),
-                email=row.get('email', ''),
-                address=row.get('address', ''),
-                gst_number=row.get('gst_number', '')
-            )
-            
-            db.session.add(supplier)
-            success_count += 1
-            
-        except Exception as e:
-            errors.append(f"Row {index + 2}: {str(e)}")
-            error_count += 1
+    is_existing = df['sku'].isin(existing.keys())
+    columns = text_columns + list(numeric_defaults)
+    bulk_insert(Product, df.loc[~is_existing, columns].to_dict('records'), on_chunk=record_imported_stock)
+    success_count = int((~is_existing).sum())
     
-    if success_count > 0:
-        db.session.commit()
+    if update_existing:
+        updates = df.loc[is_existing, ['sku', 'cost_price', 'selling_price', 'stock_quantity', 'gst_rate']]
+        updates = updates.assign(id=updates['sku'].map(existing), updated_at=datetime.utcnow()).drop(columns='sku')
+        records = updates.to_dict('records')
+        for start in range(0, len(records), IMPORT_CHUNK_SIZE):
+            chunk = records[start:start + IMPORT_CHUNK_SIZE]
+            db.session.bulk_update_mappings(Product, chunk)
+            record_stock_movements({r['id']: r['stock_quantity'] - existing_stock[r['id']] for r in chunk}, 'import')
+            bump_catalogue_version(db.session.connection(), 'products')
+            db.session.commit()
+        success_count += len(records)
+    else:
+        errors += [f"Row {index}: Product with SKU '{sku}' already exists" for index, sku in df.loc[is_existing, 'sku'].items()]
     
-    return success_count, error_count, errors
+    return success_count, len(errors), errors
+
+def import_customers(df, update_existing=False):
+    text_columns = ['name', 'phone', 'email', 'address', 'gst_number']
+    from spreadsheets import validate_import_frame
+    df, errors = validate_import_frame(df, ['name'], text_columns, {})
+    bulk_insert(Customer, df[text_columns].to_dict('records'))
+    return len(df), len(errors), errors
+
+def import_suppliers(df, update_existing=False):
+    text_columns = ['name', 'contact_person', 'phone', 'email', 'address', 'gst_number']
+    from spreadsheets import validate_import_frame
+    df, errors = validate_import_frame(df, ['name'], text_columns, {})
+    bulk_insert(Supplier, df[text_columns].to_dict('records'))
+    return len(df), len(errors), errors
 
-def import_vans(df):
+def import_vans(df, update_existing=False):
+    text_columns = ['name', 'driver_name', 'phone', 'license_number']
+    from spreadsheets import validate_import_frame
+    df, errors = validate_import_frame(df, text_columns, text_columns, {})
+    bulk_insert(Van, df[text_columns].to_dict('records'))
+    return len(df), len(errors), errors
+
+IMPORTERS = {
+    'products': import_products,
+    'customers': import_customers,
+    'suppliers': import_suppliers,
+    'vans': import_vans,
+}
+
+def run_import(import_type, stream, filename, update_existing=False, progress=None):
+    # Stream an uploaded sheet through its importer batch by batch, calling progress with the rows read so far
+    importer = IMPORTERS[import_type]
     success_count = 0
     error_count = 0
     errors = []
-    
-    required_columns = ['name', 'driver_name', 'phone', 'license_number']
-    
-    for index, row in df.iterrows():
-        try:
-            if not all(col in df.columns for col in required_columns):
-                errors.append(f"Row {index + 2}: Missing required columns. Need: {required_columns}")
-                error_count += 1
-                continue
-            
-            van = Van(
-                name=row['name'],
-                driver_name=row['driver_name'],
-                phone=row['phone'],
-                license_number=row['license_number']
-            )
-            
-            db.session.add(van)
-            success_count += 1
-            
-        except Exception as e:
-            errors.append(f"Row {index + 2}: {str(e)}")
-            error_count += 1
-    
-    if success_count > 0:
-        db.session.commit()
-    
+    rows_read = 0
+    from spreadsheets import iter_import_batches
+    for df in iter_import_batches(stream, filename, IMPORT_CHUNK_SIZE):
+        batch_success, batch_errors, batch_messages = importer(df, update_existing=update_existing)
+        success_count += batch_success
+        error_count += batch_errors
+        errors.extend(batch_messages)
+        rows_read += len(df)
+        if progress:
+            progress(rows_read)
     return success_count, error_count, errors
 
 @app.route('/products')
@@ -754,6 +1700,8 @@ def add_product():
             gst_rate=form.gst_rate.data
         )
         db.session.add(product)
+        db.session.flush()
+        record_stock_movements({product.id: product.stock_quantity or 0}, 'opening')
         db.session.commit()
         flash('Product added successfully!')
         return redirect(url_for('products'))
@@ -762,15 +1710,18 @@ def add_product():
 @app.route('/load_forms')
 @login_required
 def load_forms():
-    forms = LoadForm.query.order_by(LoadForm.date.desc()).all()
-    return render_template('load_forms.html', forms=forms)
+    query = LoadForm.query.options(
+        joinedload(LoadForm.van),
+        joinedload(LoadForm.product),
+        joinedload(LoadForm.user)
+    )
+    return render_list_page('load_forms.html', LoadForm, query, 'forms', with_customer=False)
 
 @app.route('/load_forms/add', methods=['GET', 'POST'])
 @login_required
 def add_load_form():
     form = LoadFormForm()
-    form.van_id.choices = [(v.id, v.name) for v in Van.query.all()]
-    form.product_id.choices = [(p.id, f"{p.name} ({p.sku})") for p in Product.query.all()]
+    form.van_id.choices = [(v.id, v.name) for v in catalogue.get('vans')]
     
     if form.validate_on_submit():
         load_form = LoadForm(
@@ -783,63 +1734,263 @@ def add_load_form():
             created_by=current_user.id
         )
         
-        # Update product stock
-        product = Product.query.get(form.product_id.data)
-        if form.form_type.data == 'in':
-            product.stock_quantity += form.quantity.data
-        else:  # out
-            if product.stock_quantity >= form.quantity.data:
-                product.stock_quantity -= form.quantity.data
-            else:
-                flash('Insufficient stock!')
-                return render_template('add_load_form.html', form=form)
+        def add_form():
+            db.session.add(load_form)
+            db.session.flush()
+            # Update product stock
+            quantities = {form.product_id.data: form.quantity.data}
+            if form.form_type.data == 'in':
+                unload_van_stock(form.van_id.data, quantities)
+                release_stock(quantities, 'load_in', load_form.id)
+            else:  # out
+                reserve_stock(quantities, 'load_out', load_form.id)
+                add_van_stock(form.van_id.data, quantities)
         
-        db.session.add(load_form)
-        db.session.commit()
+        try:
+            run_in_transaction(add_form)
+        except InsufficientStockError as e:
+            flash(f'{e}!')
+            return render_template('add_load_form.html', form=form)
         flash('Load form submitted successfully!')
         return redirect(url_for('load_forms'))
     
     return render_template('add_load_form.html', form=form)
 
+# Bulk load sheets
+def load_sheet_rows(quantities):
+    # Grid rows for {product_id: quantity} with product details, in SKU order
+    if not quantities:
+        return []
+    products = Product.query.filter(Product.id.in_(quantities)).order_by(Product.sku)
+    return [{'product': product, 'quantity': quantities[product.id]} for product in products]
+
+def previous_load(van_id, form_type, day):
+    # {product_id: quantity} loaded on day for a van, to pre-fill the next sheet
+    return dict(db.session.query(LoadForm.product_id, func.sum(LoadForm.quantity)).filter(
+        LoadForm.van_id == van_id, LoadForm.form_type == form_type, LoadForm.date == day
+    ).group_by(LoadForm.product_id))
+
+def load_sheet_problems(form_type, van_id, quantities):
+    # Unknown products, plus warehouse shortfalls for a load out; a load in is never short
+    stock = dict(db.session.query(Product.id, Product.stock_quantity).filter(Product.id.in_(quantities)))
+    problems = [f'Unknown product {pid}' for pid in quantities if pid not in stock]
+    if form_type != 'out':
+        return problems
+    short = {pid: qty for pid, qty in quantities.items() if pid in stock and (stock[pid] or 0) < qty}
+    names = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_(short))) if short else {}
+    problems += [f'{names[pid]}: {qty} requested, {stock[pid] or 0} in stock' for pid, qty in short.items()]
+    return problems
+
+def write_load_sheet(form_type, van_id, day, notes, quantities):
+    # Insert one LoadForm per product and apply every stock change in the caller's transaction
+    load_forms = {pid: LoadForm(
+        form_type=form_type,
+        van_id=van_id,
+        product_id=pid,
+        quantity=quantity,
+        date=day,
+        notes=notes,
+        created_by=current_user.id
+    ) for pid, quantity in quantities.items()}
+    db.session.add_all(load_forms.values())
+    db.session.flush()
+    source_ids = {pid: load_form.id for pid, load_form in load_forms.items()}
+    if form_type == 'in':
+        unload_van_stock(van_id, quantities)
+        release_stock(quantities, 'load_in', source_ids)
+    else:
+        reserve_stock(quantities, 'load_out', source_ids)
+        add_van_stock(van_id, quantities)
+
+def save_load_template(name, van_id, quantities):
+    # Create or replace the template called name with quantities
+    template = LoadTemplate.query.filter_by(name=name).first()
+    if template is None:
+        template = LoadTemplate(name=name, created_by=current_user.id)
+        db.session.add(template)
+    template.van_id = van_id
+    template.template_items = [LoadTemplateItem(product_id=pid, quantity=qty) for pid, qty in quantities.items()]
+    db.session.commit()
+
+@app.route('/load_forms/bulk', methods=['GET', 'POST'])
+@login_required
+def add_load_sheet():
+    # Load a whole van trip from one grid; a GET can pre-fill it from copy_date or template_id
+    form = LoadSheetForm()
+    form.van_id.choices = [(v.id, v.name) for v in catalogue.get('vans')]
+    templates = LoadTemplate.query.order_by(LoadTemplate.name).all()
+    quantities = {}
+    
+    if request.method == 'GET':
+        form.van_id.data = request.args.get('van_id', type=int) or form.van_id.data
+        form.form_type.data = request.args.get('form_type') or form.form_type.data
+        if request.args.get('template_id'):
+            template = db.session.get(LoadTemplate, request.args.get('template_id', type=int))
+            if template:
+                quantities = {item.product_id: item.quantity for item in template.template_items}
+                form.van_id.data = form.van_id.data or template.van_id
+        elif request.args.get('copy_date') and form.van_id.data:
+            try:
+                copy_date = date.fromisoformat(request.args['copy_date'])
+            except ValueError:
+                flash(f"Invalid date: {request.args['copy_date']}", 'error')
+            else:
+                quantities = previous_load(form.van_id.data, form.form_type.data, copy_date)
+                if not quantities:
+                    flash(f'No {form.form_type.data} load found for that van on {copy_date}.', 'error')
+    
+    elif form.validate_on_submit():
+        try:
+            quantities = submitted_quantities()
+        except ValueError:
+            problems = ['Every quantity must be a whole number']
+        else:
+            problems = (load_sheet_problems(form.form_type.data, form.van_id.data, quantities) if quantities
+                        else ['Enter a quantity for at least one product'])
+        if not problems:
+            try:
+                run_in_transaction(write_load_sheet, form.form_type.data, form.van_id.data,
+                                   form.date.data, form.notes.data, quantities)
+            except InsufficientStockError as e:
+                # Stock moved between the check and the write
+                problems = [f"Product {s['product_id']}: {s['requested']} requested, {s['available']} in stock"
+                            for s in e.shortfalls]
+        if problems:
+            for problem in problems:
+                flash(problem, 'error')
+        else:
+            template_name = (form.template_name.data or '').strip()
+            if template_name:
+                save_load_template(template_name, form.van_id.data, quantities)
+            flash(f'Load sheet submitted: {len(quantities)} products, {sum(quantities.values())} units.')
+            return redirect(url_for('load_forms'))
+    else:
+        try:
+            quantities = submitted_quantities()
+        except ValueError:
+            pass
+    
+    return render_template('add_load_sheet.html',
+                         form=form,
+                         rows=load_sheet_rows(quantities),
+                         templates=templates,
+                         yesterday=date.today() - timedelta(days=1))
+
 @app.route('/stock_report')
 @login_required
 def stock_report():
     products = Product.query.all()
     return render_template('stock_report.html', products=products)
 
+# Monthly stock report
+STOCK_REPORT_PAGE_SIZE = 500
+STOCK_ADJUSTMENT_KINDS = ['opening', 'import', 'adjustment']
+
+def movement_total(kinds, sign=1):
+    # SUM of ledger quantities for kinds, as a conditional aggregate
+    return func.sum(case((StockMovement.kind.in_(kinds), StockMovement.quantity * sign), else_=0))
+
+def monthly_movement_totals(month_start, next_month):
+    # Load in/out, sold, returned and adjusted per product over the month's slice of the ledger
+    return db.session.query(
+        StockMovement.product_id,
+        movement_total(['load_in']),
+        movement_total(['load_out'], -1),
+        movement_total(['sale'], -1),
+        movement_total(['return']),
+        movement_total(STOCK_ADJUSTMENT_KINDS)
+    ).filter(
+        StockMovement.date >= datetime.combine(month_start, datetime.min.time()),
+        StockMovement.date < datetime.combine(next_month, datetime.min.time())
+    ).group_by(StockMovement.product_id)
+
+def monthly_stock_rows(month_start, next_month):
+    # Per-product opening, movements and closing stock, from the opening snapshot and the month's ledger slice
+    opening = stock_levels_on(month_start)
+    totals = {row[0]: row[1:] for row in monthly_movement_totals(month_start, next_month)}
+    
+    headers = ['SKU', 'Product', 'Category', 'Opening', 'Load In', 'Load Out', 'Sold', 'Returned', 'Adjusted', 'Closing']
+    def rows():
+        for pid, sku, name, category in db.session.query(
+            Product.id, Product.sku, Product.name, Product.category
+        ).order_by(Product.sku):
+            if pid not in opening and pid not in totals:
+                continue
+            load_in, load_out, sold, returned, adjusted = totals.get(pid, (0, 0, 0, 0, 0))
+            start = opening.get(pid, 0)
+            yield (sku, name, category, start, load_in, load_out, sold, returned, adjusted,
+                   start + load_in - load_out - sold + returned + adjusted)
+    return headers, rows()
+
+def monthly_van_stock_query(month_start, next_month):
+    # Load in/out, sold and returned per van and product, each movement's van taken from its source document
+    van_id = func.coalesce(Sale.van_id, Return.van_id, LoadForm.van_id)
+    return db.session.query(
+        Van.name, Product.sku, Product.name,
+        movement_total(['load_in']),
+        movement_total(['load_out'], -1),
+        movement_total(['sale'], -1),
+        movement_total(['return'])
+    ).select_from(StockMovement).join(Product, Product.id == StockMovement.product_id).outerjoin(
+        Sale, and_(StockMovement.kind == 'sale', Sale.id == StockMovement.source_id)
+    ).outerjoin(
+        Return, and_(StockMovement.kind == 'return', Return.id == StockMovement.source_id)
+    ).outerjoin(
+        LoadForm, and_(StockMovement.kind.in_(['load_in', 'load_out']), LoadForm.id == StockMovement.source_id)
+    ).outerjoin(Van, Van.id == van_id).filter(
+        StockMovement.date >= datetime.combine(month_start, datetime.min.time()),
+        StockMovement.date < datetime.combine(next_month, datetime.min.time()),
+        StockMovement.kind.in_(['load_in', 'load_out', 'sale', 'return'])
+    ).group_by(Van.name, Product.sku, Product.name).order_by(Van.name, Product.sku)
+
+def monthly_van_stock_rows(month_start, next_month):
+    headers = ['Van', 'SKU', 'Product', 'Load In', 'Load Out', 'Sold', 'Returned']
+    query = monthly_van_stock_query(month_start, next_month)
+    return headers, ((van or 'No van', *rest) for van, *rest in query)
+
 @app.route('/monthly_stock_report')
 @login_required
 def monthly_stock_report():
     month = request.args.get('month', datetime.now().strftime('%Y-%m'))
-    year, month_num = month.split('-')
+    month_start, next_month = month_range(month)
+    by_van = request.args.get('group') == 'van'
     
-    # Get stock movements for the month
-    load_forms = LoadForm.query.filter(
-        and_(
-            func.extract('year', LoadForm.date) == int(year),
-            func.extract('month', LoadForm.date) == int(month_num)
-        )
-    ).all()
+    report = monthly_van_stock_rows if by_van else monthly_stock_rows
+    headers, rows = report(month_start, next_month)
+    if request.args.get('format') == 'xlsx':
+        title = f"stock_{'van_' if by_van else ''}{month}"
+        from spreadsheets import write_xlsx
+        return send_file(write_xlsx(headers, rows, title), as_attachment=True, download_name=f'{title}.xlsx',
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
     
-    return render_template('monthly_stock_report.html', 
-                         load_forms=load_forms, 
+    rows = list(rows)
+    number_columns = range(3, len(headers))
+    totals = [sum(row[i] for row in rows) for i in number_columns]
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_count = max((len(rows) - 1) // STOCK_REPORT_PAGE_SIZE + 1, 1)
+    return render_template('monthly_stock_report.html',
+                         headers=headers,
+                         rows=rows[(page - 1) * STOCK_REPORT_PAGE_SIZE:page * STOCK_REPORT_PAGE_SIZE],
+                         totals=totals,
+                         row_count=len(rows),
+                         page=page,
+                         page_count=page_count,
+                         by_van=by_van,
                          selected_month=month)
 
 @app.route('/van_sales_monthly')
 @login_required
 def van_sales_monthly():
     month = request.args.get('month', datetime.now().strftime('%Y-%m'))
-    year, month_num = month.split('-')
+    month_start, next_month = month_range(month)
     
     van_sales = db.session.query(
         Van.name,
-        func.sum(Sale.final_amount).label('total_sales'),
-        func.count(Sale.id).label('total_orders')
-    ).join(Sale).filter(
-        and_(
-            func.extract('year', Sale.date) == int(year),
-            func.extract('month', Sale.date) == int(month_num)
-        )
+        func.sum(DailySalesRollup.final_amount).label('total_sales'),
+        func.sum(DailySalesRollup.order_count).label('total_orders')
+    ).join(DailySalesRollup, DailySalesRollup.van_id == Van.id).filter(
+        DailySalesRollup.day >= month_start,
+        DailySalesRollup.day < next_month
     ).group_by(Van.id, Van.name).all()
     
     return render_template('van_sales_monthly.html', 
@@ -853,7 +2004,7 @@ def investment_report():
     total_purchases = db.session.query(func.sum(Purchase.final_amount)).scalar() or 0
     
     # Calculate total sales
-    total_sales = db.session.query(func.sum(Sale.final_amount)).scalar() or 0
+    total_sales = db.session.query(func.sum(DailySalesRollup.final_amount)).scalar() or 0
     
     # Calculate profit/loss
     profit_loss = total_sales - total_purchases
@@ -866,24 +2017,29 @@ def investment_report():
 @app.route('/sales')
 @login_required
 def sales():
-    sales = Sale.query.order_by(Sale.date.desc()).all()
-    return render_template('sales.html', sales=sales)
+    query = Sale.query.options(
+        joinedload(Sale.customer),
+        joinedload(Sale.van)
+    )
+    return render_list_page('sales.html', Sale, query, 'sales')
 
 @app.route('/sales/add', methods=['GET', 'POST'])
 @login_required
 def add_sale():
     form = SaleForm()
-    form.customer_id.choices = [(0, 'Walk-in Customer')] + [(c.id, c.name) for c in Customer.query.all()]
-    form.van_id.choices = [(0, 'No Van')] + [(v.id, v.name) for v in Van.query.all()]
+    form.customer_id.choices = [(0, 'Walk-in Customer')] + [(c.id, c.name) for c in catalogue.get('customers')]
+    form.van_id.choices = [(0, 'No Van')] + [(v.id, v.name) for v in catalogue.get('vans')]
     
     if form.validate_on_submit():
+        van_id = form.van_id.data if form.van_id.data != 0 else None
+        
         # Generate invoice number
-        invoice_number = f"INV{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        invoice_number = next_document_number('invoice', van_id=van_id)
         
         sale = Sale(
             invoice_number=invoice_number,
             customer_id=form.customer_id.data if form.customer_id.data != 0 else None,
-            van_id=form.van_id.data if form.van_id.data != 0 else None,
+            van_id=van_id,
             total_amount=0.0,  # Initialize with 0, will be updated when items are added
             gst_amount=0.0,
             discount_amount=0.0,
@@ -907,31 +2063,34 @@ def add_sale_items(sale_id):
     
     if request.method == 'POST':
         product_id = request.form.get('product_id')
-        quantity = int(request.form.get('quantity'))
+        quantity = request.form.get('quantity', type=int)
         
         product = Product.query.get(product_id)
-        if product and product.stock_quantity >= quantity:
-            unit_price = product.selling_price
-            total_price = unit_price * quantity
-            
-            sale_item = SaleItem(
+        
+        def add_item():
+            db.session.add(SaleItem(
                 sale_id=sale_id,
-                product_id=product_id,
+                product_id=product.id,
                 quantity=quantity,
-                unit_price=unit_price,
-                total_price=total_price,
+                unit_price=product.selling_price,
+                total_price=product.selling_price * quantity,
                 gst_rate=product.gst_rate
-            )
-            
+            ))
             # Update product stock
-            product.stock_quantity -= quantity
-            
-            db.session.add(sale_item)
-            db.session.commit()
-            
-            flash('Item added successfully!')
+            if sale.van_id:
+                take_van_stock(sale.van_id, {product.id: quantity})
+            reserve_stock({product.id: quantity}, 'sale', sale_id)
+        
+        if not quantity or quantity <= 0:
+            flash('Enter a positive quantity!', 'error')
         else:
-            flash('Insufficient stock!')
+            try:
+                if not product:
+                    raise InsufficientStockError([])
+                run_in_transaction(add_item)
+                flash('Item added successfully!')
+            except InsufficientStockError as e:
+                flash(f'{e}!')
     
     # Calculate totals
     sale_items = SaleItem.query.filter_by(sale_id=sale_id).all()
@@ -945,16 +2104,216 @@ def add_sale_items(sale_id):
     sale.final_amount = total_amount
     db.session.commit()
     
-    products = Product.query.filter(Product.stock_quantity > 0).all()
     
     return render_template('add_sale_items.html', 
                          sale=sale, 
                          sale_items=sale_items,
-                         products=products,
                          subtotal=subtotal,
                          gst_amount=gst_amount,
                          total_amount=total_amount)
 
+# Product search
+PRODUCT_SEARCH_LIMIT = 20
+
+def product_json(product):
+    return {
+        'id': product.id,
+        'name': product.name,
+        'sku': product.sku,
+        'category': product.category,
+        'selling_price': product.selling_price,
+        'gst_rate': product.gst_rate,
+        'stock_quantity': product.stock_quantity,
+    }
+
+def has_product_fts():
+    # Whether the product_fts index exists, checked once per process
+    if not hasattr(has_product_fts, 'result'):
+        has_product_fts.result = db.engine.dialect.name == 'sqlite' and bool(db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'product_fts'")
+        ).scalar())
+    return has_product_fts.result
+
+def search_products(term, limit=PRODUCT_SEARCH_LIMIT):
+    # Products whose name, SKU or category match every word of term as a prefix
+    words = [word for word in re.split(r'\W+', term) if word]
+    if not words:
+        return []
+    if has_product_fts():
+        match = ' '.join(f'"{word}"*' for word in words)
+        ids = [row[0] for row in db.session.execute(
+            text('SELECT rowid FROM product_fts WHERE product_fts MATCH :match ORDER BY rank LIMIT :limit'),
+            {'match': match, 'limit': limit}
+        )]
+        products = {p.id: p for p in Product.query.filter(Product.id.in_(ids))}
+        return [products[i] for i in ids if i in products]
+    query = Product.query
+    for word in words:
+        pattern = f'{word}%'
+        query = query.filter(or_(Product.name.ilike(pattern), Product.name.ilike(f'% {pattern}'),
+                                 Product.sku.ilike(pattern), Product.category.ilike(pattern)))
+    return query.order_by(Product.name).limit(limit).all()
+
+@app.route('/api/products/search')
+@login_required
+def api_product_search():
+    limit = max(1, min(request.args.get('limit', PRODUCT_SEARCH_LIMIT, type=int), 100))
+    return jsonify([product_json(p) for p in search_products(request.args.get('q', ''), limit)])
+
+@app.route('/api/products/sku/<path:sku>')
+@login_required
+def api_product_by_sku(sku):
+    # Exact SKU/barcode lookup on the unique sku index, for scanners
+    product = Product.query.filter_by(sku=sku.strip()).first()
+    if not product:
+        return jsonify({'error': f'No product with SKU {sku}'}), 404
+    return jsonify(product_json(product))
+
+# Sale lookup
+SALE_SEARCH_LIMIT = 20
+
+def sale_json(sale):
+    return {
+        'id': sale.id,
+        'invoice_number': sale.invoice_number,
+        'date': sale.date.strftime('%Y-%m-%d'),
+        'customer': sale.customer.name if sale.customer else 'Walk-in',
+        'van': sale.van.name if sale.van else None,
+        'final_amount': sale.final_amount,
+        'payment_method': sale.payment_method,
+    }
+
+def search_sales(term, filters, limit=SALE_SEARCH_LIMIT):
+    # Recent sales matching term as an invoice number prefix, then by customer name or phone
+    query = apply_list_filters(
+        Sale.query.options(joinedload(Sale.customer), joinedload(Sale.van)), Sale, filters
+    ).order_by(Sale.date.desc(), Sale.id.desc())
+    term = term.strip()
+    if not term:
+        return query.limit(limit).all()
+    
+    prefix = term.upper()
+    sales = query.filter(
+        Sale.invoice_number >= prefix,
+        Sale.invoice_number < prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    ).limit(limit).all()
+    if len(sales) < limit:
+        customers = select(Customer.id).where(or_(Customer.name.ilike(f'%{term}%'), Customer.phone.startswith(term)))
+        found = [sale.id for sale in sales]
+        sales += query.filter(Sale.customer_id.in_(customers), Sale.id.notin_(found)).limit(limit - len(sales)).all()
+    return sales
+
+@app.route('/api/sales/search')
+@login_required
+def api_sale_search():
+    # Sales for the return form lookup; accepts q plus the sales list filters
+    limit = max(1, min(request.args.get('limit', SALE_SEARCH_LIMIT, type=int), 100))
+    return jsonify([sale_json(s) for s in search_sales(request.args.get('q', ''), parse_list_filters(), limit)])
+
+@app.route('/api/checkout', methods=['POST'])
+@login_required
+def api_checkout():
+    # Create a sale and all its lines in one transaction from a JSON basket
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'No items in basket'}), 400
+    payment_method = data.get('payment_method', 'cash')
+    if not isinstance(payment_method, str) or payment_method not in dict(PAYMENT_METHODS):
+        return jsonify({'error': 'Invalid payment method'}), 400
+    is_gst_invoice = data.get('is_gst_invoice', True)
+    if not isinstance(is_gst_invoice, bool):
+        return jsonify({'error': 'is_gst_invoice must be true or false'}), 400
+    
+    # Optional references must be JSON integers naming existing rows, checked
+    # before an invoice number is allocated for them
+    references = {}
+    for field, model in (('customer_id', Customer), ('van_id', Van)):
+        value = data.get(field)
+        if value is None:
+            references[field] = None
+            continue
+        if type(value) is not int:
+            return jsonify({'error': f'{field} must be an integer'}), 400
+        if db.session.get(model, value) is None:
+            return jsonify({'error': f'Unknown {field} {value}'}), 400
+        references[field] = value
+    
+    # Merge repeated lines for the same product
+    quantities = {}
+    for item in items:
+        if not isinstance(item, dict) or not all(
+                type(item.get(key)) is int and item[key] > 0 for key in ('product_id', 'quantity')):
+            return jsonify({'error': 'Each item needs a positive integer product_id and quantity'}), 400
+        quantities[item['product_id']] = quantities.get(item['product_id'], 0) + item['quantity']
+    
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(quantities)).all()}
+    unknown = [{'product_id': product_id, 'error': 'Unknown product'}
+               for product_id in quantities if product_id not in products]
+    if unknown:
+        return jsonify({'error': 'Basket cannot be fulfilled', 'items': unknown}), 409
+    
+    try:
+        sale = run_in_transaction(write_checkout_sale, references['customer_id'], references['van_id'],
+                                  payment_method, quantities, products, is_gst_invoice)
+    except InsufficientStockError as e:
+        problems = [dict(shortfall, error=str(e)) for shortfall in e.shortfalls]
+        return jsonify({'error': 'Basket cannot be fulfilled', 'items': problems}), 409
+    
+    return jsonify({
+        'sale_id': sale.id,
+        'invoice_number': sale.invoice_number,
+        'subtotal': sale.total_amount,
+        'gst_amount': sale.gst_amount,
+        'final_amount': sale.final_amount,
+        'invoice_url': url_for('generate_invoice', sale_id=sale.id),
+    }), 201
+
+def write_checkout_sale(customer_id, van_id, payment_method, quantities, products, is_gst_invoice):
+    # Insert the sale, its items and the stock decrements for a validated checkout basket
+    # Numbers come from their own short transaction, so take one before any writes
+    invoice_number = next_document_number('invoice', van_id=van_id)
+    sale = Sale(
+        invoice_number=invoice_number,
+        customer_id=customer_id,
+        van_id=van_id,
+        total_amount=0.0,
+        gst_amount=0.0,
+        discount_amount=0.0,
+        final_amount=0.0,
+        payment_method=payment_method,
+        is_gst_invoice=is_gst_invoice,
+        created_by=current_user.id
+    )
+    db.session.add(sale)
+    
+    subtotal = 0.0
+    gst_amount = 0.0
+    for product_id, quantity in quantities.items():
+        product = products[product_id]
+        total_price = product.selling_price * quantity
+        sale.sale_items.append(SaleItem(
+            product_id=product_id,
+            quantity=quantity,
+            unit_price=product.selling_price,
+            total_price=total_price,
+            gst_rate=product.gst_rate
+        ))
+        subtotal += total_price
+        if is_gst_invoice:
+            gst_amount += total_price * product.gst_rate / 100
+    
+    sale.total_amount = subtotal
+    sale.gst_amount = gst_amount
+    sale.final_amount = subtotal + gst_amount
+    db.session.flush()
+    if sale.van_id:
+        take_van_stock(sale.van_id, quantities)
+    reserve_stock(quantities, 'sale', sale.id)
+    return sale
+
 @app.route('/invoice/<int:sale_id>')
 @login_required
 def generate_invoice(sale_id):
@@ -963,47 +2322,897 @@ def generate_invoice(sale_id):
     
     return render_template('invoice.html', sale=sale, sale_items=sale_items)
 
+# PDF documents
+app.config.setdefault('PDF_WORKERS', 2)
+app.config.setdefault('PDF_RENDER_TIMEOUT', 60)
+app.config.setdefault('PDF_CACHE_DIR', os.path.join(app.instance_path, 'pdf'))
+app.config.setdefault('PDF_CACHE_MAX_AGE_DAYS', 7)  # cached PDFs unused for this long are deleted
+FILE_SWEEP_INTERVAL = 3600
+pdf_executor = None
+pdf_lock = threading.Lock()
+pdf_renders = {}  # cache path -> Future, so concurrent downloads share one render
+file_sweeps = {}  # directory -> time of its last sweep
+
+def sweep_old_files(directory, max_age_days):
+    # Delete files in directory not modified for max_age_days, at most once an hour per directory
+    now = time.time()
+    if now - file_sweeps.get(directory, 0) < FILE_SWEEP_INTERVAL:
+        return
+    file_sweeps[directory] = now
+    cutoff = now - max_age_days * 86400
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def money(amount):
+    return f'Rs.{amount or 0:.2f}'
+
+def document_lines(items, is_gst):
+    # Table rows for sale or return items, with the GST columns only on GST invoices
+    header = ['#', 'Product', 'Quantity', 'Unit Price', 'Total'] + (['GST Rate', 'GST Amount'] if is_gst else [])
+    rows = [header]
+    for number, item in enumerate(items, 1):
+        row = [number, item.product.name, item.quantity, money(item.unit_price), money(item.total_price)]
+        if is_gst:
+            row += [f'{item.gst_rate}%', money(item.total_price * item.gst_rate / 100)]
+        rows.append(row)
+    return rows
+
+def party_lines(customer, fallback):
+    if not customer:
+        return [fallback]
+    lines = [customer.name, customer.address]
+    lines += [f'Phone: {customer.phone}' if customer.phone else None,
+              f'GST: {customer.gst_number}' if customer.gst_number else None]
+    return [line for line in lines if line]
+
+def invoice_document(sale, items=None):
+    # Everything printed on a sale's invoice, as plain data; pass items when they are already loaded
+    if items is None:
+        items = SaleItem.query.options(joinedload(SaleItem.product)).filter_by(sale_id=sale.id).order_by(SaleItem.id)
+    van = [sale.van.name, f'Driver: {sale.van.driver_name}' if sale.van.driver_name else None,
+           f'Phone: {sale.van.phone}' if sale.van.phone else None] if sale.van else ['Store Sale']
+    totals = [['Subtotal', money(sale.total_amount)]]
+    if sale.is_gst_invoice:
+        totals.append(['GST Amount', money(sale.gst_amount)])
+    totals.append(['Total Amount', money(sale.final_amount)])
+    return {
+        'title': 'GST Invoice' if sale.is_gst_invoice else 'Bill',
+        'details': [['Invoice No', sale.invoice_number], ['Date', sale.date.strftime('%Y-%m-%d %H:%M')]],
+        'blocks': [['Bill To', party_lines(sale.customer, 'Walk-in Customer')],
+                   ['Sold By', [line for line in van if line]]],
+        'lines': document_lines(items, sale.is_gst_invoice),
+        'totals': totals,
+        'footer': f'Payment Method: {(sale.payment_method or "cash").title()}',
+    }
+
+def return_document(return_obj):
+    # Everything printed on a return receipt, as plain data for a render worker
+    is_gst = return_obj.sale.is_gst_invoice
+    items = ReturnItem.query.options(joinedload(ReturnItem.product)).filter_by(return_id=return_obj.id).order_by(ReturnItem.id)
+    totals = [['Subtotal', money(return_obj.total_amount)]]
+    if is_gst:
+        totals.append(['GST Amount', money(return_obj.gst_amount)])
+    totals.append(['Total Refund Amount', money(return_obj.final_amount)])
+    return {
+        'title': 'Return Receipt',
+        'details': [['Return No', return_obj.return_number], ['Date', return_obj.date.strftime('%Y-%m-%d %H:%M')],
+                    ['Original Sale', return_obj.sale.invoice_number]],
+        'blocks': [['Return To', party_lines(return_obj.customer, 'Walk-in Customer')],
+                   ['Return Reason', [return_obj.reason or '']]],
+        'lines': document_lines(items, is_gst),
+        'totals': totals,
+        'footer': '',
+    }
+
+def render_pdf_documents(documents, path, title):
+    # Write documents to path as one PDF; runs in a PDF worker, the only place reportlab is imported
+    import pdf_render
+    pdf_render.render_pdf_documents(documents, path, title)
+
+def render_pdf_document(document, path):
+    render_pdf_documents([document], path, document['title'])
+
+def get_pdf_executor():
+    global pdf_executor
+    with pdf_lock:
+        if pdf_executor is None:
+            # spawn, not fork: forking a threaded server process can copy held locks into the child
+            pdf_executor = ProcessPoolExecutor(max_workers=app.config['PDF_WORKERS'],
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return pdf_executor
+
+def cached_pdfs(kind, documents):
+    # Paths of the PDFs for [(doc_id, document)], keyed by a hash of their content, rendering missing ones in parallel
+    directory = app.config['PDF_CACHE_DIR']
+    paths, missing = [], {}
+    for doc_id, document in documents:
+        digest = hashlib.sha256(json.dumps(document, sort_keys=True).encode()).hexdigest()[:16]
+        path = os.path.join(directory, f'{kind}-{doc_id}-{digest}.pdf')
+        paths.append(path)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            missing[path] = (doc_id, document)
+    if not missing:
+        return paths
+    
+    os.makedirs(directory, exist_ok=True)
+    sweep_old_files(directory, app.config['PDF_CACHE_MAX_AGE_DAYS'])
+    executor = get_pdf_executor()
+    futures = {}
+    with pdf_lock:
+        for path, (doc_id, document) in missing.items():
+            if path not in pdf_renders:
+                pdf_renders[path] = executor.submit(render_pdf_document, document, path)
+            futures[path] = pdf_renders[path]
+    try:
+        for future in futures.values():
+            future.result(timeout=app.config['PDF_RENDER_TIMEOUT'])
+    finally:
+        with pdf_lock:
+            for path in futures:
+                pdf_renders.pop(path, None)
+    return paths
+
+def cached_pdf(kind, doc_id, document):
+    return cached_pdfs(kind, [(doc_id, document)])[0]
+
+@app.route('/invoice/<int:sale_id>/pdf')
+@login_required
+def invoice_pdf(sale_id):
+    sale = Sale.query.options(joinedload(Sale.customer), joinedload(Sale.van)).filter_by(id=sale_id).first_or_404()
+    path = cached_pdf('invoice', sale.id, invoice_document(sale))
+    return send_file(path, mimetype='application/pdf', as_attachment=True,
+                     download_name=f'{sale.invoice_number}.pdf')
+
+@app.route('/return_receipt/<int:return_id>/pdf')
+@login_required
+def return_receipt_pdf(return_id):
+    return_obj = Return.query.options(joinedload(Return.customer), joinedload(Return.sale)).filter_by(id=return_id).first_or_404()
+    path = cached_pdf('return', return_obj.id, return_document(return_obj))
+    return send_file(path, mimetype='application/pdf', as_attachment=True,
+                     download_name=f'{return_obj.return_number}.pdf')
+
+BATCH_INVOICE_CHUNK = 200
+
+def batch_invoice_ids(filters):
+    # Ids of the sales matching filters, oldest first
+    return [row[0] for row in apply_list_filters(db.session.query(Sale.id), Sale, filters).order_by(Sale.date, Sale.id)]
+
+def batch_invoice_chunks(ids):
+    # Yield [(sale, document)] for ids one BATCH_INVOICE_CHUNK at a time, two queries per chunk
+    for start in range(0, len(ids), BATCH_INVOICE_CHUNK):
+        chunk = ids[start:start + BATCH_INVOICE_CHUNK]
+        sales = {sale.id: sale for sale in Sale.query.options(
+            joinedload(Sale.customer), joinedload(Sale.van)
+        ).filter(Sale.id.in_(chunk))}
+        items = {}
+        for item in SaleItem.query.options(joinedload(SaleItem.product)).filter(
+            SaleItem.sale_id.in_(chunk)
+        ).order_by(SaleItem.id):
+            items.setdefault(item.sale_id, []).append(item)
+        yield [(sales[i], invoice_document(sales[i], items.get(i, []))) for i in chunk if i in sales]
+
+class ZipStream:
+    # Write-only sink for zipfile that hands back what was written so far, for streaming
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def render_invoice_parts(ids, name):
+    # Yield (part, path) PDFs of up to BATCH_INVOICE_CHUNK invoices, with at most PDF_WORKERS rendering at once
+    directory = app.config['PDF_CACHE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    executor = get_pdf_executor()
+    pending = deque()
+    
+    def finished(part, path, future, timeout):
+        future.result(timeout=timeout)
+        return part, path
+    
+    try:
+        for part, chunk in enumerate(batch_invoice_chunks(ids), 1):
+            path = os.path.join(directory, f'batch-{uuid.uuid4().hex}.pdf')
+            documents = [document for _, document in chunk]
+            timeout = app.config['PDF_RENDER_TIMEOUT'] * (1 + len(documents) // 100)
+            pending.append((part, path, executor.submit(render_pdf_documents, documents, path, f'{name} part {part}'), timeout))
+            if len(pending) >= app.config['PDF_WORKERS']:
+                yield finished(*pending.popleft())
+        while pending:
+            yield finished(*pending.popleft())
+    finally:
+        # Abandoned download: drop parts that were never handed out
+        for part, path, future, timeout in pending:
+            future.cancel()
+            try:
+                future.result(timeout=timeout)
+                os.remove(path)
+            except Exception:
+                pass
+
+def stream_file(path, remove=False, chunk_size=64 * 1024):
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+    finally:
+        if remove:
+            os.remove(path)
+
+@app.route('/invoices/batch')
+@login_required
+def batch_invoices():
+    # A van's invoices for a date range: one PDF up to BATCH_INVOICE_CHUNK, else a ZIP of parts
+    filters = parse_list_filters()
+    if not filters['date_from'] and not filters['date_to']:
+        filters['date_from'] = filters['date_to'] = date.today()
+    van = db.session.get(Van, filters['van_id']) if filters['van_id'] else None
+    name = f"invoices_{secure_filename(van.name) if van else 'all'}_{filters['date_from'] or ''}_{filters['date_to'] or ''}"
+    ids = batch_invoice_ids(filters)
+    if not ids:
+        flash('No invoices found for that van and date range.', 'error')
+        return redirect(url_for('sales', **request.args))
+    
+    if request.args.get('format') == 'zip':
+        def generate():
+            sink = ZipStream()
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+                for chunk in batch_invoice_chunks(ids):
+                    paths = cached_pdfs('invoice', [(sale.id, document) for sale, document in chunk])
+                    for (sale, _), path in zip(chunk, paths):
+                        archive.write(path, f'{secure_filename(sale.invoice_number)}.pdf')
+                        yield sink.drain()
+            yield sink.drain()
+        return Response(stream_with_context(generate()), mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename={name}.zip'})
+    
+    if len(ids) <= BATCH_INVOICE_CHUNK:
+        part, path = next(render_invoice_parts(ids, name))
+        return Response(stream_file(path, remove=True), mimetype='application/pdf',
+                        headers={'Content-Disposition': f'attachment; filename={name}.pdf'})
+    
+    def generate():
+        sink = ZipStream()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+            for part, path in render_invoice_parts(ids, name):
+                try:
+                    archive.write(path, f'{name}_part{part}.pdf')
+                finally:
+                    os.remove(path)
+                yield sink.drain()
+        yield sink.drain()
+    return Response(stream_with_context(generate()), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={name}.zip'})
+
+# Export engine
+EXPORT_CHUNK_SIZE = 1000
+
+def export_stock_rows(filters):
+    query = db.session.query(
+        Product.sku, Product.name, Product.category, Product.stock_quantity,
+        Product.min_stock_level, Product.cost_price, Product.selling_price
+    ).order_by(Product.sku)
+    headers = ['SKU', 'Product Name', 'Category', 'Stock Quantity', 'Min Stock Level', 'Cost Price', 'Selling Price']
+    return headers, query.yield_per(EXPORT_CHUNK_SIZE)
+
+def export_sales_rows(filters):
+    query = db.session.query(
+        Sale.invoice_number, Sale.date, Customer.name, Van.name,
+        Sale.total_amount, Sale.gst_amount, Sale.final_amount, Sale.payment_method
+    ).outerjoin(Customer, Sale.customer_id == Customer.id).outerjoin(Van, Sale.van_id == Van.id)
+    query = apply_list_filters(query, Sale, filters)
+    query = query.order_by(Sale.date, Sale.id)
+    headers = ['Invoice Number', 'Date', 'Customer', 'Van', 'Total Amount', 'GST Amount', 'Final Amount', 'Payment Method']
+    rows = ((inv, d.strftime('%Y-%m-%d'), customer or 'Walk-in', van or 'N/A', total, gst, final, method)
+            for inv, d, customer, van, total, gst, final, method in query.yield_per(EXPORT_CHUNK_SIZE))
+    return headers, rows
+
+def export_sale_items_rows(filters):
+    query = db.session.query(
+        Sale.invoice_number, Sale.date, Van.name, Product.sku, Product.name,
+        SaleItem.quantity, SaleItem.unit_price, SaleItem.total_price, SaleItem.gst_rate
+    ).join(Sale, SaleItem.sale_id == Sale.id).join(Product, SaleItem.product_id == Product.id) \
+        .outerjoin(Van, Sale.van_id == Van.id)
+    query = apply_list_filters(query, Sale, filters)
+    query = query.order_by(Sale.date, Sale.id, SaleItem.id)
+    headers = ['Invoice Number', 'Date', 'Van', 'SKU', 'Product Name', 'Quantity', 'Unit Price', 'Total Price', 'GST Rate']
+    rows = ((inv, d.strftime('%Y-%m-%d'), van or 'N/A', sku, name, qty, unit, total, gst)
+            for inv, d, van, sku, name, qty, unit, total, gst in query.yield_per(EXPORT_CHUNK_SIZE))
+    return headers, rows
+
+def export_returns_rows(filters):
+    query = db.session.query(
+        Return.return_number, Return.date, Sale.invoice_number, Customer.name, Van.name,
+        Return.total_amount, Return.gst_amount, Return.final_amount, Return.reason
+    ).join(Sale, Return.sale_id == Sale.id).outerjoin(Customer, Return.customer_id == Customer.id) \
+        .outerjoin(Van, Return.van_id == Van.id)
+    query = apply_list_filters(query, Return, filters)
+    query = query.order_by(Return.date, Return.id)
+    headers = ['Return Number', 'Date', 'Original Invoice', 'Customer', 'Van', 'Total Amount', 'GST Amount', 'Final Amount', 'Reason']
+    rows = ((ret, d.strftime('%Y-%m-%d'), inv, customer or 'Walk-in', van or 'N/A', total, gst, final, reason)
+            for ret, d, inv, customer, van, total, gst, final, reason in query.yield_per(EXPORT_CHUNK_SIZE))
+    return headers, rows
+
+def export_load_forms_rows(filters):
+    query = db.session.query(
+        LoadForm.date, LoadForm.form_type, Van.name, Product.sku, Product.name,
+        LoadForm.quantity, LoadForm.notes, User.username
+    ).join(Van, LoadForm.van_id == Van.id).join(Product, LoadForm.product_id == Product.id) \
+        .join(User, LoadForm.created_by == User.id)
+    query = apply_list_filters(query, LoadForm, filters)
+    query = query.order_by(LoadForm.date, LoadForm.id)
+    headers = ['Date', 'Type', 'Van', 'SKU', 'Product Name', 'Quantity', 'Notes', 'Created By']
+    rows = ((d.strftime('%Y-%m-%d'), form_type.upper(), van, sku, name, qty, notes or '', username)
+            for d, form_type, van, sku, name, qty, notes, username in query.yield_per(EXPORT_CHUNK_SIZE))
+    return headers, rows
+
+EXPORT_REPORTS = {
+    'stock': export_stock_rows,
+    'sales': export_sales_rows,
+    'sale_items': export_sale_items_rows,
+    'returns': export_returns_rows,
+    'load_forms': export_load_forms_rows,
+}
+
+def stream_csv(headers, rows):
+    # Yield CSV text in chunks of EXPORT_CHUNK_SIZE rows
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
 @app.route('/export_excel/<report_type>')
 @login_required
 def export_excel(report_type):
-    if report_type == 'stock':
-        products = Product.query.all()
-        df = pd.DataFrame([{
-            'SKU': p.sku,
-            'Product Name': p.name,
-            'Category': p.category,
-            'Stock Quantity': p.stock_quantity,
-            'Min Stock Level': p.min_stock_level,
-            'Cost Price': p.cost_price,
-            'Selling Price': p.selling_price
-        } for p in products])
-        
-        filename = f'stock_report_{datetime.now().strftime("%Y%m%d")}.xlsx'
-        df.to_excel(filename, index=False)
-        
-        return send_file(filename, as_attachment=True)
-    
-    elif report_type == 'sales':
-        sales = Sale.query.all()
-        df = pd.DataFrame([{
-            'Invoice Number': s.invoice_number,
-            'Date': s.date.strftime('%Y-%m-%d'),
-            'Customer': s.customer.name if s.customer else 'Walk-in',
-            'Van': s.van.name if s.van else 'N/A',
-            'Total Amount': s.total_amount,
-            'GST Amount': s.gst_amount,
-            'Final Amount': s.final_amount,
-            'Payment Method': s.payment_method
-        } for s in sales])
+    if report_type not in EXPORT_REPORTS:
+        flash('Invalid report type!', 'error')
+        return redirect(url_for('dashboard'))
+    
+    filters = parse_list_filters()
+    export_format = request.args.get('format', 'xlsx')
+    if request.args.get('background'):
+        job = submit_job('export', report_type, export_task, report_type, filters, export_format)
+        return redirect(url_for('job_status', job_id=job.id))
+    
+    headers, rows = EXPORT_REPORTS[report_type](filters)
+    filename = f'{report_type}_report_{datetime.now().strftime("%Y%m%d")}'
+    
+    if export_format == 'csv':
+        return Response(
+            stream_with_context(stream_csv(headers, rows)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename={filename}.csv'}
+        )
+    
+    from spreadsheets import write_xlsx
+    output = write_xlsx(headers, rows, report_type)
+    return send_file(output, as_attachment=True, download_name=f'{filename}.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+# Background jobs
+JOB_MAX_ERRORS = 1000
+app.config.setdefault('JOB_WORKERS', 2)
+app.config.setdefault('JOB_FILES_DIR', os.path.join(app.instance_path, 'jobs'))
+app.config.setdefault('JOB_FILES_MAX_AGE_DAYS', 7)  # export results are deleted after this long
+job_executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='pos-job')
+# Live row counts for running exports. Committing mid-export would close the
+# streaming cursor, so progress is kept here and persisted when the job ends.
+live_job_rows = {}
+
+def save_job_file(upload):
+    # Copy an upload into the job directory so a worker can read it after the request ends
+    os.makedirs(app.config['JOB_FILES_DIR'], exist_ok=True)
+    path = os.path.join(app.config['JOB_FILES_DIR'], f"{uuid.uuid4().hex}_{secure_filename(upload.filename)}")
+    upload.save(path)
+    return path
+
+def submit_job(job_type, name, task, *args):
+    # Record a queued job and hand task(job, *args) to the worker pool
+    sweep_old_files(app.config['JOB_FILES_DIR'], app.config['JOB_FILES_MAX_AGE_DAYS'])
+    job = Job(job_type=job_type, name=name, created_by=current_user.id)
+    db.session.add(job)
+    db.session.commit()
+    job_executor.submit(run_job, job.id, task, *args)
+    return job
+
+def run_job(job_id, task, *args):
+    with app.app_context():
+        job = Job.query.get(job_id)
+        job.status = 'running'
+        db.session.commit()
+        try:
+            task(job, *args)
+            job.status = 'done'
+        except Exception as e:
+            app.logger.exception('Job %s failed', job_id)
+            db.session.rollback()
+            live_job_rows.pop(job_id, None)
+            job = Job.query.get(job_id)
+            job.status = 'failed'
+            job.errors = json.dumps(json.loads(job.errors or '[]') + [str(e)])
+            job.error_count += 1
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+def import_task(job, import_type, path, filename, update_existing):
+    def progress(rows):
+        job.rows_processed = rows
+        db.session.commit()
+    
+    try:
+        with open(path, 'rb') as stream:
+            success_count, error_count, errors = run_import(import_type, stream, filename,
+                                                            update_existing=update_existing, progress=progress)
+    finally:
+        os.remove(path)
+    job.error_count = error_count
+    job.errors = json.dumps(errors[:JOB_MAX_ERRORS])
+
+def export_task(job, report_type, filters, export_format):
+    headers, rows = EXPORT_REPORTS[report_type](filters)
+    job.download_name = f'{report_type}_report_{datetime.now().strftime("%Y%m%d")}.{export_format}'
+    os.makedirs(app.config['JOB_FILES_DIR'], exist_ok=True)
+    path = os.path.join(app.config['JOB_FILES_DIR'], f'job{job.id}_{job.download_name}')
+    def counted(rows):
+        for count, row in enumerate(rows, 1):
+            live_job_rows[job.id] = count
+            yield row
+    
+    if export_format == 'csv':
+        with open(path, 'w', newline='', encoding='utf-8') as output:
+            for chunk in stream_csv(headers, counted(rows)):
+                output.write(chunk)
+    else:
+        from spreadsheets import write_xlsx
+        write_xlsx(headers, counted(rows), report_type, output=path)
+    job.rows_processed = live_job_rows.pop(job.id, 0)
+    job.result_file = path
+
+def get_job_or_404(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.created_by != current_user.id and current_user.role != 'admin':
+        abort(404)
+    return job
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = get_job_or_404(job_id)
+    return render_template('job_status.html', job=job)
+
+@app.route('/jobs/<int:job_id>/progress')
+@login_required
+def job_progress(job_id):
+    job = get_job_or_404(job_id)
+    return jsonify({
+        'id': job.id,
+        'job_type': job.job_type,
+        'name': job.name,
+        'status': job.status,
+        'rows_processed': max(job.rows_processed or 0, live_job_rows.get(job.id, 0)),
+        'error_count': job.error_count,
+        'errors': json.loads(job.errors or '[]')[:50],
+        'download_url': url_for('job_download', job_id=job.id) if job.status == 'done' and job.result_file else None,
+    })
+
+@app.route('/jobs/<int:job_id>/download')
+@login_required
+def job_download(job_id):
+    job = get_job_or_404(job_id)
+    if job.status != 'done' or not job.result_file or not os.path.exists(job.result_file):
+        abort(404)
+    return send_file(job.result_file, as_attachment=True, download_name=job.download_name)
+
+# Request metrics
+# Upper bounds (seconds) of the request duration histogram buckets; the last bucket is +Inf
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+
+class RouteMetrics:
+    # Running totals for one route since the process started
+    __slots__ = ('buckets', 'seconds', 'db_seconds', 'statements', 'objects_loaded', 'rows_written', 'statuses')
+    
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.objects_loaded = 0
+        self.rows_written = 0
+        self.statuses = {}  # (method, status) -> requests
+    
+    @property
+    def requests(self):
+        return sum(self.buckets)
+    
+    def quantile(self, q):
+        # Estimate a latency quantile from the histogram, as Prometheus' histogram_quantile does
+        rank = q * self.requests
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(METRICS_BUCKETS, self.buckets):
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return METRICS_BUCKETS[-1]
+
+metrics_lock = threading.Lock()
+route_metrics = {}  # url rule -> RouteMetrics
+metrics_started = time.time()
+
+# One timer for every SQL statement, shared by the request metrics and the query profiler
+TimedStatement = namedtuple('TimedStatement', 'conn cursor statement parameters context executemany elapsed error')
+statement_listeners = []
+
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    timed = TimedStatement(conn, cursor, statement, parameters, context, executemany, elapsed, None)
+    for listener in statement_listeners:
+        listener(timed)
+
+def abandon_statement_timer(exception_context):
+    # after_cursor_execute is skipped when a statement raises; still pop its
+    # start time, and report the time spent (e.g. waiting on a lock)
+    conn = exception_context.connection
+    started = conn.info.get('query_started') if conn is not None else None
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    timed = TimedStatement(conn, None, exception_context.statement or '',
+                           exception_context.parameters, exception_context.execution_context, False,
+                           elapsed, exception_context.original_exception)
+    for listener in statement_listeners:
+        listener(timed)
+
+def watch_statements(listener):
+    # Call listener with a TimedStatement after every SQL statement, including ones that raise
+    if not statement_listeners:
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', start_statement_timer)
+            event.listen(db.engine, 'after_cursor_execute', stop_statement_timer)
+            event.listen(db.engine, 'handle_error', abandon_statement_timer)
+    statement_listeners.append(listener)
+
+def record_statement_metrics(timed):
+    if has_request_context() and 'metrics_started' in g:
+        g.db_seconds += timed.elapsed
+        g.db_statements += 1
+        # SELECT rows are fetched after this event, so reads are only counted as ORM objects load
+        context = timed.context
+        if (timed.error is None and context is not None and (context.isinsert or context.isupdate or context.isdelete)
+                and timed.cursor.rowcount > 0):
+            g.db_rows_written += timed.cursor.rowcount
+
+def count_loaded_object(target, context):
+    if has_request_context() and 'metrics_started' in g:
+        g.db_objects_loaded += 1
+
+if app.config['METRICS_ENABLED']:
+    watch_statements(record_statement_metrics)
+    event.listen(db.Model, 'load', count_loaded_object, propagate=True)
+    
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.db_seconds = 0.0
+        g.db_statements = 0
+        g.db_objects_loaded = 0
+        g.db_rows_written = 0
+    
+    @app.after_request
+    def note_response_status(response):
+        g.response_status = response.status_code
+        return response
+    
+    @app.teardown_request
+    def record_request_metrics(exc):
+        # Runs after a streamed response has finished, so exports are timed in full
+        if 'metrics_started' not in g:
+            return
+        elapsed = time.perf_counter() - g.metrics_started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = g.get('response_status', 500)
+        bucket = next((i for i, upper in enumerate(METRICS_BUCKETS) if elapsed <= upper), len(METRICS_BUCKETS))
+        with metrics_lock:
+            stats = route_metrics.get(route)
+            if stats is None:
+                stats = route_metrics[route] = RouteMetrics()
+            stats.buckets[bucket] += 1
+            stats.seconds += elapsed
+            stats.db_seconds += g.db_seconds
+            stats.statements += g.db_statements
+            stats.objects_loaded += g.db_objects_loaded
+            stats.rows_written += g.db_rows_written
+            key = (request.method, status)
+            stats.statuses[key] = stats.statuses.get(key, 0) + 1
+
+def metrics_summary(limit=None):
+    # Per-route latency and database figures, slowest p95 first
+    with metrics_lock:
+        summary = []
+        for route, stats in route_metrics.items():
+            requests = stats.requests
+            summary.append({
+                'route': route,
+                'requests': requests,
+                'errors': sum(n for (method, status), n in stats.statuses.items() if status >= 500),
+                **{f'p{round(q * 100)}_ms': round(stats.quantile(q) * 1000, 1) for q in METRICS_QUANTILES},
+                'avg_ms': round(stats.seconds / requests * 1000, 1),
+                'avg_db_ms': round(stats.db_seconds / requests * 1000, 1),
+                'avg_statements': round(stats.statements / requests, 1),
+                'avg_objects_loaded': round(stats.objects_loaded / requests, 1),
+                'avg_rows_written': round(stats.rows_written / requests, 1),
+            })
+    summary.sort(key=lambda row: row['p95_ms'], reverse=True)
+    return summary[:limit]
+
+def prometheus_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def prometheus_metrics():
+    # All route metrics in the Prometheus text exposition format
+    families = {
+        'pos_http_requests_total': ('counter', 'Requests handled, by route, method and status.', []),
+        'pos_http_request_duration_seconds': ('histogram', 'Wall time from request start to the end of the response.', []),
+        'pos_db_seconds_total': ('counter', 'Time spent executing SQL statements.', []),
+        'pos_db_statements_total': ('counter', 'SQL statements executed.', []),
+        'pos_db_objects_loaded_total': ('counter', 'ORM model objects loaded; column-only SELECT rows are not counted.', []),
+        'pos_db_rows_written_total': ('counter', 'Rows changed by INSERT/UPDATE/DELETE.', []),
+    }
+    with metrics_lock:
+        for route, stats in sorted(route_metrics.items()):
+            label = f'route="{prometheus_label(route)}"'
+            for (method, status), count in sorted(stats.statuses.items()):
+                families['pos_http_requests_total'][2].append(
+                    f'pos_http_requests_total{{{label},method="{method}",status="{status}"}} {count}')
+            histogram = families['pos_http_request_duration_seconds'][2]
+            cumulative = 0
+            for upper, count in zip(METRICS_BUCKETS + ('+Inf',), stats.buckets):
+                cumulative += count
+                histogram.append(f'pos_http_request_duration_seconds_bucket{{{label},le="{upper}"}} {cumulative}')
+            histogram.append(f'pos_http_request_duration_seconds_sum{{{label}}} {stats.seconds:.6f}')
+            histogram.append(f'pos_http_request_duration_seconds_count{{{label}}} {cumulative}')
+            families['pos_db_seconds_total'][2].append(f'pos_db_seconds_total{{{label}}} {stats.db_seconds:.6f}')
+            families['pos_db_statements_total'][2].append(f'pos_db_statements_total{{{label}}} {stats.statements}')
+            families['pos_db_objects_loaded_total'][2].append(f'pos_db_objects_loaded_total{{{label}}} {stats.objects_loaded}')
+            families['pos_db_rows_written_total'][2].append(f'pos_db_rows_written_total{{{label}}} {stats.rows_written}')
+    lines = ['# HELP pos_process_start_time_seconds When this process started collecting metrics.',
+             '# TYPE pos_process_start_time_seconds gauge',
+             f'pos_process_start_time_seconds {metrics_started:.3f}']
+    for name, (kind, description, samples) in families.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}'] + samples
+    return '\n'.join(lines) + '\n'
+
+def metrics_access_allowed():
+    token = app.config['METRICS_TOKEN']
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    return current_user.is_authenticated and current_user.role == 'admin'
+
+@app.route('/metrics')
+def metrics():
+    if not metrics_access_allowed():
+        abort(403)
+    return Response(prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/summary')
+def metrics_summary_json():
+    if not metrics_access_allowed():
+        abort(403)
+    return jsonify(routes=metrics_summary(), since=datetime.fromtimestamp(metrics_started).isoformat())
+
+# Query profiler
+# Most statements one request to these endpoints may run; others get QUERY_BUDGET_DEFAULT
+QUERY_BUDGET_DEFAULT = 25
+QUERY_BUDGETS = {
+    'dashboard': 10,
+    'products': 10,
+    'sales': 10,
+    'returns': 10,
+    'load_forms': 10,
+    'add_return': 10,
+    'add_return_items': 10,
+    'export_excel': 10,
+}
+# Pages visited by check-query-budgets: (endpoint, url arguments)
+QUERY_BUDGET_PAGES = [
+    ('dashboard', {}), ('products', {}), ('sales', {}), ('returns', {}), ('load_forms', {}),
+    ('add_return', {}), ('stock_report', {}), ('monthly_stock_report', {}), ('van_sales_monthly', {}),
+    ('investment_report', {}), ('vans', {}), ('export_excel', {'report_type': 'sales', 'format': 'csv'}),
+    ('export_excel', {'report_type': 'returns', 'format': 'csv'}),
+    ('export_excel', {'report_type': 'load_forms', 'format': 'csv'}),
+]
+
+class QueryBudgetExceeded(AssertionError):
+    def __init__(self, endpoint, statements, budget):
+        super().__init__(f'{endpoint} ran {statements} SQL statements; its budget is {budget}')
+        self.endpoint = endpoint
+        self.statements = statements
+        self.budget = budget
+
+IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)|\(\s*%\(\w+\)s(?:\s*,\s*%\(\w+\)s)+\s*\)')
+
+def query_fingerprint(statement):
+    # The statement with whitespace and expanded IN lists normalised, so repeats compare equal
+    return IN_LIST.sub('(?...)', ' '.join(statement.split()))
+
+def query_origin():
+    # Where the running query came from: the template line if one is rendering, else app.py
+    # Start above profile_statement and the statement timer that called it
+    frame = sys._getframe(3)
+    app_line = None
+    while frame is not None:
+        template = frame.f_globals.get('__jinja_template__')
+        if template is not None:
+            return f"{template.name or '<string>'}:{template.get_corresponding_lineno(frame.f_lineno)}"
+        if app_line is None and frame.f_code.co_filename == __file__:
+            app_line = f'app.py:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return app_line or 'unknown'
+
+def query_plan(conn, statement, parameters):
+    # EXPLAIN output for a statement that just ran, read on the same connection
+    explain = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(explain + statement, parameters)
+        return [str(row[-1]) for row in cursor.fetchall()]
+    except Exception as e:
+        return [f'plan unavailable: {e}']
+    finally:
+        cursor.close()
+
+def record_profiled_query(statement, elapsed, origin):
+    entry = g.query_profile.setdefault(query_fingerprint(statement), {'count': 0, 'seconds': 0.0, 'origins': {}})
+    entry['count'] += 1
+    entry['seconds'] += elapsed
+    entry['origins'][origin] = entry['origins'].get(origin, 0) + 1
+
+def profile_statement(timed):
+    origin = None
+    if has_request_context() and 'query_profile' in g:
+        origin = query_origin()
+        record_profiled_query(timed.statement, timed.elapsed, origin)
+    if timed.elapsed * 1000 < app.config['SLOW_QUERY_MS']:
+        return
+    statement = ' '.join(timed.statement.split())
+    if timed.error is not None:
+        # Lock waits before an error are often the slowest statements of all
+        app.logger.warning('Slow failed query (%.0f ms) from %s: %s\n  params: %r\n  error: %s',
+                           timed.elapsed * 1000, origin or query_origin(), statement, timed.parameters, timed.error)
+        return
+    plan = [] if timed.executemany else query_plan(timed.conn, timed.statement, timed.parameters)
+    app.logger.warning('Slow query (%.0f ms) from %s: %s\n  params: %r\n  plan: %s',
+                       timed.elapsed * 1000, origin or query_origin(), statement,
+                       timed.parameters, ' | '.join(plan) or 'n/a')
+
+def query_budget(endpoint):
+    return QUERY_BUDGETS.get(endpoint, QUERY_BUDGET_DEFAULT)
+
+def repeated_queries(profile):
+    # Fingerprints run at least QUERY_REPEAT_THRESHOLD times, most repeated first
+    threshold = app.config['QUERY_REPEAT_THRESHOLD']
+    repeats = [(fingerprint, entry) for fingerprint, entry in profile.items() if entry['count'] >= threshold]
+    return sorted(repeats, key=lambda item: item[1]['count'], reverse=True)
+
+if app.config['QUERY_PROFILER']:
+    watch_statements(profile_statement)
+    
+    @app.before_request
+    def start_query_profile():
+        g.query_profile = {}
+    
+    @app.teardown_request
+    def check_query_profile(exc):
+        # Runs after a streamed response has finished, so export queries are included
+        if 'query_profile' not in g:
+            return
+        route = f'{request.method} {request.path}'
+        for fingerprint, entry in repeated_queries(g.query_profile):
+            origins = ', '.join(f'{origin} x{count}' for origin, count in entry['origins'].items())
+            app.logger.warning('Possible N+1 on %s: %d x %s\n  from %s', route, entry['count'], fingerprint, origins)
+        statements = sum(entry['count'] for entry in g.query_profile.values())
+        budget = query_budget(request.endpoint)
+        if statements > budget:
+            app.logger.warning('%s ran %d SQL statements; budget for %s is %d', route, statements, request.endpoint, budget)
+            if app.config['QUERY_BUDGET_STRICT'] and exc is None:
+                raise QueryBudgetExceeded(request.endpoint, statements, budget)
+
+@app.cli.command('check-query-budgets')
+def check_query_budgets_command():
+    """Load the main pages as an admin and fail if any goes over its query budget or repeats a query."""
+    if not app.config['QUERY_PROFILER']:
+        print('Set POS_QUERY_PROFILER=true to check query budgets')
+        raise SystemExit(2)
+    admin = User.query.filter_by(role='admin').first()
+    if admin is None:
+        print('Needs an admin user; run the app once first')
+        raise SystemExit(2)
+    pages = list(QUERY_BUDGET_PAGES)
+    # This command reports budget overruns itself rather than raising mid-request
+    app.config['QUERY_BUDGET_STRICT'] = False
+    first_return = db.session.query(Return.id).order_by(Return.id).limit(1).scalar()
+    if first_return is not None:
+        pages.append(('add_return_items', {'return_id': first_return}))
+    
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin.id)
+        session['_fresh'] = True
+    
+    def visit(url):
+        # GET url and return the response with the request's query profile
+        profiles = []
         
-        filename = f'sales_report_{datetime.now().strftime("%Y%m%d")}.xlsx'
-        df.to_excel(filename, index=False)
+        def keep_profile(sender, **extra):
+            profiles.append(dict(g.get('query_profile', {})))
         
-        return send_file(filename, as_attachment=True)
+        with request_tearing_down.connected_to(keep_profile, app):
+            response = client.get(url)
+            response.get_data()
+            response.close()
+        return response, profiles[-1] if profiles else {}
+    
+    failed = False
+    for endpoint, args in pages:
+        with app.test_request_context():
+            url = url_for(endpoint, **args)
+        # A fresh context makes the request push its own app context and session,
+        # as in production, instead of reusing this command's identity map
+        response, profile = contextvars.Context().run(visit, url)
+        statements = sum(entry['count'] for entry in profile.values())
+        budget = query_budget(endpoint)
+        repeats = repeated_queries(profile)
+        ok = response.status_code == 200 and statements <= budget and not repeats
+        failed = failed or not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {url:<45} {response.status_code} {statements:>3}/{budget} statements")
+        for fingerprint, entry in repeats:
+            print(f"       {entry['count']} x {fingerprint[:120]}")
+            print(f"         from {', '.join(entry['origins'])}")
+    if failed:
+        raise SystemExit(1)
 
-if __name__ == '__main__':
+# Production server
+def prepare_database():
+    # Create and migrate the schema and seed required rows; run once, before serving
     with app.app_context():
         db.create_all()
+        run_migrations()
         
         # Create admin user if not exists
         admin = User.query.filter_by(username='admin').first()
@@ -1016,5 +3225,108 @@ if __name__ == '__main__':
             )
             db.session.add(admin)
             db.session.commit()
+        
+        # Backfill rollups for databases created before they existed
+        if not DailySalesRollup.query.first() and Sale.query.first():
+            rebuild_sales_rollups()
+        
+        # Catch up on monthly stock snapshots missed while the app was down
+        take_stock_snapshots()
+        
+        # Jobs left queued or running by the last shutdown will never finish
+        Job.query.filter(Job.status.in_(['queued', 'running'])).update(
+            {'status': 'failed', 'finished_at': datetime.utcnow(),
+             'errors': json.dumps(['Interrupted by a server restart']), 'error_count': 1},
+            synchronize_session=False)
+        db.session.commit()
+        # Worker processes open their own connections
+        db.engine.dispose()
+
+def stop_background_work():
+    # Let running jobs and PDF renders finish before the process exits
+    deadline = time.monotonic() + app.config['SERVER_SHUTDOWN_TIMEOUT']
+    waiter = threading.Thread(target=job_executor.shutdown, kwargs={'cancel_futures': True}, daemon=True)
+    waiter.start()
+    waiter.join(timeout=max(0, deadline - time.monotonic()))
+    if waiter.is_alive():
+        app.logger.warning('Background jobs still running after %ss; stopping anyway',
+                           app.config['SERVER_SHUTDOWN_TIMEOUT'])
+    if pdf_executor is not None:
+        pdf_executor.shutdown(wait=False, cancel_futures=True)
+
+def drain_server(server, socket_map):
+    # Stop accepting connections, then keep serving until in-flight requests have been answered
+    from waitress import wasyncore
+    from waitress.channel import HTTPChannel
+    from waitress.server import BaseWSGIServer
+    
+    for listener in [d for d in socket_map.values() if isinstance(d, BaseWSGIServer)]:
+        # Close only the listening socket; open channels still need the server's trigger
+        wasyncore.dispatcher.close(listener)
+    dispatcher = server.task_dispatcher
+    def busy():
+        return dispatcher.active_count or dispatcher.queue or any(
+            channel.requests or channel.total_outbufs_len
+            for channel in list(socket_map.values()) if isinstance(channel, HTTPChannel)
+        )
+    
+    deadline = time.monotonic() + app.config['SERVER_SHUTDOWN_TIMEOUT']
+    while busy() and time.monotonic() < deadline:
+        wasyncore.loop(timeout=0.05, map=socket_map, use_poll=server.adj.asyncore_use_poll, count=1)
+    if busy():
+        app.logger.warning('Requests still running after %ss; stopping anyway', app.config['SERVER_SHUTDOWN_TIMEOUT'])
+    dispatcher.shutdown(timeout=max(deadline - time.monotonic(), 1))
+    wasyncore.close_all(socket_map)
+
+def serve(host=None, port=None, threads=None):
+    # Serve the app with waitress until Ctrl+C or SIGTERM, then drain and shut down cleanly
+    from waitress import create_server, wasyncore
+    from waitress.server import MultiSocketServer
     
-    app.run(debug=True)
+    server = create_server(
+        app,
+        host=host or app.config['SERVER_HOST'],
+        port=port or app.config['SERVER_PORT'],
+        threads=threads or app.config['SERVER_THREADS'],
+        connection_limit=app.config['SERVER_CONNECTION_LIMIT'],
+        channel_timeout=app.config['SERVER_CHANNEL_TIMEOUT'],
+        ident='POS System',
+    )
+    
+    # Several listen addresses give a MultiSocketServer whose servers share one map
+    socket_map = server.map if isinstance(server, MultiSocketServer) else server._map
+    stopping = []
+    
+    def stop(signum, frame):
+        stopping.append(signum)
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"POS System serving on http://{server.effective_host}:{server.effective_port} "
+          f"with {threads or app.config['SERVER_THREADS']} threads (Ctrl+C to stop)")
+    # Poll one step at a time instead of server.run(), whose shutdown only waits 5s and
+    # drops queued requests
+    while not stopping:
+        wasyncore.loop(timeout=server.adj.asyncore_loop_timeout, map=socket_map,
+                       use_poll=server.adj.asyncore_use_poll, count=1)
+    drain_server(server, socket_map)
+    stop_background_work()
+
+@app.cli.command('serve')
+@click.option('--host', help='Interface to listen on (default SERVER_HOST).')
+@click.option('--port', type=int, help='Port to listen on (default SERVER_PORT).')
+@click.option('--threads', type=int, help='Requests handled at once (default SERVER_THREADS).')
+def serve_command(host, port, threads):
+    """Prepare the database, then run the production server."""
+    prepare_database()
+    serve(host, port, threads)
+
+if __name__ == '__main__':
+    # In the PyInstaller exe, PDF worker processes start by running this entry
+    # point; freeze_support() turns them into workers instead of new servers
+    multiprocessing.freeze_support()
+    prepare_database()
+    if '--debug' in sys.argv:
+        app.run(debug=True)
+    else:
+        serve()
@@ -0,0 +1,124 @@
+"""Commit throughput benchmark for the supported database configurations.
+
+Runs the same checkout-shaped write transaction (sale, sale item, stock
+decrement and ledger row) from several threads against each mode and reports
+commits per second:
+
+    sqlite-default   rollback journal, synchronous=FULL (SQLite's defaults)
+    sqlite-tuned     the app's defaults: WAL, synchronous=NORMAL, busy_timeout, cache and mmap
+    postgresql       only when --postgres URI is given; use a scratch database
+
+    python bench_db.py [--threads 8] [--transactions 200] [--postgres postgresql://...]
+
+Each mode runs in its own process, since the database settings are read when
+app.py is imported.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SQLITE_DEFAULTS = {
+    'POS_SQLITE_JOURNAL_MODE': 'DELETE',
+    'POS_SQLITE_SYNCHRONOUS': 'FULL',
+    'POS_SQLITE_CACHE_SIZE': '-2000',
+    'POS_SQLITE_MMAP_SIZE': '0',
+}
+
+def run_mode(args):
+    """Body of one benchmark process; prints a JSON result line."""
+    from app import app, db, User, Product, Sale, SaleItem, reserve_stock, run_in_transaction
+
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username='bench').first()
+        if not user:
+            user = User(username='bench', email='bench@example.com', password_hash='-', role='staff')
+            db.session.add(user)
+        products = []
+        for i in range(args.threads):
+            product = Product.query.filter_by(sku=f'BENCH{i}').first()
+            if not product:
+                product = Product(name=f'Bench {i}', sku=f'BENCH{i}', category='Bench', cost_price=1.0, selling_price=2.0)
+                db.session.add(product)
+            product.stock_quantity = args.transactions * 10
+            products.append(product)
+        db.session.commit()
+        user_id = user.id
+        product_ids = [p.id for p in products]
+
+    counters = {'commits': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def checkout(n, product_id):
+        sale = Sale(invoice_number=f'BENCH-{os.getpid()}-{n}', total_amount=2.0, final_amount=2.0, created_by=user_id)
+        sale.sale_items.append(SaleItem(product_id=product_id, quantity=1, unit_price=2.0, total_price=2.0, gst_rate=0))
+        db.session.add(sale)
+        db.session.flush()
+        reserve_stock({product_id: 1}, 'sale', sale.id)
+
+    def till(worker):
+        with app.app_context():
+            for i in range(args.transactions):
+                try:
+                    run_in_transaction(checkout, worker * args.transactions + i, product_ids[worker])
+                except Exception as e:
+                    db.session.rollback()
+                    print(f'till {worker}: {e}', file=sys.stderr)
+                    with lock:
+                        counters['errors'] += 1
+                    continue
+                with lock:
+                    counters['commits'] += 1
+
+    threads = [threading.Thread(target=till, args=(n,)) for n in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    print(json.dumps(dict(counters, seconds=elapsed)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--transactions', type=int, default=200, help='transactions per thread')
+    parser.add_argument('--postgres', help='URI of a scratch PostgreSQL database to include')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return run_mode(args)
+
+    db_dir = tempfile.mkdtemp(prefix='pos_bench_')
+    modes = [
+        ('sqlite-default', dict(SQLITE_DEFAULTS, POS_DATABASE_URI='sqlite:///' + os.path.join(db_dir, 'default.db'))),
+        ('sqlite-tuned', {'POS_DATABASE_URI': 'sqlite:///' + os.path.join(db_dir, 'tuned.db')}),
+    ]
+    if args.postgres:
+        modes.append(('postgresql', {'POS_DATABASE_URI': args.postgres}))
+
+    print(f'{args.threads} threads x {args.transactions} transactions')
+    print(f"{'mode':<16}{'commits':>9}{'errors':>8}{'seconds':>9}{'commits/s':>11}")
+    try:
+        for name, env in modes:
+            command = [sys.executable, os.path.abspath(__file__), '--run',
+                       '--threads', str(args.threads), '--transactions', str(args.transactions)]
+            result = subprocess.run(command, env=dict(os.environ, **env), capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            if result.returncode:
+                print(f'{name:<16}failed:\n{result.stderr}')
+                continue
+            stats = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f"{name:<16}{stats['commits']:>9}{stats['errors']:>8}{stats['seconds']:>9.2f}"
+                  f"{stats['commits'] / stats['seconds']:>11.0f}")
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Cold-start benchmark: how long a till takes to come up.
+
+Starts fresh Python processes and times three phases of each start:
+
+    import          importing app.py (models, routes, config)
+    prepare         prepare_database() against an empty database
+    first request   the first GET /login through the test client
+
+It also reports whether any heavy optional library (pandas, openpyxl,
+reportlab, numpy) was loaded before the first request. Those belong behind
+the lazily imported spreadsheets.py and pdf_render.py modules.
+
+    python bench_startup.py [--runs 5] [--max-seconds 1.5]
+
+Exits non-zero if a heavy library was loaded at startup or the median
+time to first request is over --max-seconds, so it can run as a CI check.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ('pandas', 'openpyxl', 'reportlab', 'numpy')
+
+def run_once():
+    """Body of one benchmark process; prints a JSON result line."""
+    started = time.perf_counter()
+    from app import app, prepare_database
+    imported = time.perf_counter()
+    prepare_database()
+    prepared = time.perf_counter()
+    response = app.test_client().get('/login')
+    answered = time.perf_counter()
+    print(json.dumps({
+        'import': imported - started,
+        'prepare': prepared - imported,
+        'first_request': answered - prepared,
+        'total': answered - started,
+        'status': response.status_code,
+        'heavy': [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=1.5,
+                        help='fail if the median time to first request is above this')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return run_once()
+
+    db_dir = tempfile.mkdtemp(prefix='pos_startup_')
+    results = []
+    try:
+        for n in range(args.runs):
+            env = dict(os.environ, POS_DATABASE_URI='sqlite:///' + os.path.join(db_dir, f'startup{n}.db'))
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run'], env=env,
+                                    capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            if result.returncode:
+                print(f'run {n} failed:\n{result.stderr}')
+                sys.exit(1)
+            results.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    print(f"{'phase':<15}{'median':>9}{'min':>9}{'max':>9}  ({args.runs} runs, seconds)")
+    for phase in ('import', 'prepare', 'first_request', 'total'):
+        times = [r[phase] for r in results]
+        print(f'{phase:<15}{statistics.median(times):>9.3f}{min(times):>9.3f}{max(times):>9.3f}')
+
+    heavy = sorted({name for r in results for name in r['heavy']})
+    failed = False
+    if heavy:
+        print(f"loaded at startup: {', '.join(heavy)}")
+        failed = True
+    if any(r['status'] != 200 for r in results):
+        print('first request did not return 200')
+        failed = True
+    if statistics.median(r['total'] for r in results) > args.max_seconds:
+        print(f'median startup is over {args.max_seconds}s')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""Gunicorn settings for running the POS System on Linux servers.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Windows shops use ``python app.py`` (waitress) instead; gunicorn does not run
+on Windows. Settings come from the same POS_ environment variables as the app.
+"""
+import os
+
+bind = f"{os.environ.get('POS_SERVER_HOST', '0.0.0.0')}:{os.environ.get('POS_SERVER_PORT', '5000')}"
+workers = int(os.environ.get('POS_SERVER_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('POS_SERVER_THREADS', 8))
+# A worker stuck on one request this long is killed and replaced
+timeout = int(os.environ.get('POS_SERVER_REQUEST_TIMEOUT', 120))
+# On SIGTERM, workers get this long to finish in-flight requests
+graceful_timeout = int(os.environ.get('POS_SERVER_SHUTDOWN_TIMEOUT', 30))
+keepalive = 5
+
+def on_starting(server):
+    # Migrations and seeding run once in the master, before any worker starts
+    from app import prepare_database
+    prepare_database()
+
+def worker_exit(server, worker):
+    from app import stop_background_work
+    stop_background_work()
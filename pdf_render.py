@@ -0,0 +1,50 @@
+# PDF layout for the invoice and return receipt dicts built in app.py; reportlab is slow
+# to import, so only the PDF worker processes import this module
+import os
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import mm
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
+
+def document_story(document, styles):
+    # Flowables for one document from invoice_document/return_document
+    story = [
+        Table([[Paragraph('POS System', styles['Title']), Paragraph(document['title'], styles['Heading2'])],
+               [Paragraph('Wholesale Business', styles['Normal']),
+                Paragraph('<br/>'.join(f'<b>{label}:</b> {escape(value)}' for label, value in document['details']), styles['Normal'])]],
+              colWidths=['50%', '50%']),
+        Spacer(1, 6 * mm),
+        Table([[Paragraph(f'<b>{heading}:</b><br/>' + '<br/>'.join(map(escape, lines)), styles['Normal'])
+                for heading, lines in document['blocks']]], colWidths=['50%', '50%']),
+        Spacer(1, 6 * mm),
+    ]
+    width = len(document['lines'][0])
+    rows = document['lines'] + [[''] * (width - 2) + [label, value] for label, value in document['totals']]
+    table = Table(rows, repeatRows=1)
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#366092')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('GRID', (0, 0), (-1, len(document['lines']) - 1), 0.5, colors.grey),
+        ('FONTNAME', (0, len(document['lines'])), (-1, -1), 'Helvetica-Bold'),
+        ('ALIGN', (2, 1), (-1, -1), 'RIGHT'),
+    ]))
+    story.append(table)
+    if document['footer']:
+        story += [Spacer(1, 6 * mm), Paragraph(escape(document['footer']), styles['Normal'])]
+    return story
+
+def render_pdf_documents(documents, path, title):
+    # Write documents to path as one PDF, each starting on a new page
+    styles = getSampleStyleSheet()
+    story = []
+    for document in documents:
+        if story:
+            story.append(PageBreak())
+        story += document_story(document, styles)
+    partial = f'{path}.{os.getpid()}.tmp'
+    SimpleDocTemplate(partial, pagesize=letter, title=title).build(story)
+    os.replace(partial, path)
@@ -22,6 +22,9 @@ a = Analysis(
         'openpyxl',
         'reportlab',
         'sqlalchemy',
+        'waitress',
+        'spreadsheets',
+        'pdf_render',
     ],
     hookspath=[],
     hooksconfig={},
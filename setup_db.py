@@ -1,4 +1,4 @@
-from app import app, db, User, Product, Supplier, Customer, Van
+from app import app, db, User, Product, Supplier, Customer, Van, run_migrations, record_stock_movements
 from werkzeug.security import generate_password_hash
 from datetime import datetime
 
@@ -6,6 +6,7 @@ def setup_database():
     with app.app_context():
         # Create all tables
         db.create_all()
+        run_migrations()
         
         # Create admin user if not exists
         admin = User.query.filter_by(username='admin').first()
@@ -112,13 +113,19 @@ def setup_database():
             }
         ]
         
+        created_products = []
         for product_data in sample_products:
             existing_product = Product.query.filter_by(sku=product_data['sku']).first()
             if not existing_product:
                 product = Product(**product_data)
                 db.session.add(product)
+                created_products.append(product)
                 print(f"Sample product created: {product_data['name']}")
         
+        # Record the sample stock in the stock ledger
+        db.session.flush()
+        record_stock_movements({p.id: p.stock_quantity for p in created_products}, 'opening')
+        
         # Commit all changes
         db.session.commit()
         print("\nDatabase setup completed successfully!")
@@ -0,0 +1,100 @@
+# Excel and CSV reading and writing for imports and exports; pandas and openpyxl are slow
+# to import, so app.py only imports this module where spreadsheets are needed
+import csv
+import io
+import os
+import tempfile
+
+import openpyxl
+import pandas as pd
+
+def clean_text_column(series):
+    # Coerce a column to stripped strings, keeping whole numbers (phones) free of '.0'
+    if pd.api.types.is_float_dtype(series) and (series.dropna() % 1 == 0).all():
+        series = series.astype('Int64')
+    return series.astype(object).where(series.notna(), '').astype(str).str.strip()
+
+def validate_import_frame(df, required_columns, text_columns, numeric_defaults):
+    # Validate and coerce a DataFrame indexed by sheet row; returns clean rows and errors numbered by sheet row
+    missing = [col for col in required_columns if col not in df.columns]
+    if missing:
+        raise ValueError(f"Missing required columns. Need: {required_columns}")
+    
+    df = df.copy()
+    invalid = pd.Series('', index=df.index)
+    
+    for col in text_columns:
+        df[col] = clean_text_column(df[col]) if col in df.columns else ''
+    for col in required_columns:
+        if col in text_columns:
+            invalid = invalid.where(df[col] != '', invalid + f"missing '{col}'; ")
+    
+    for col, default in numeric_defaults.items():
+        raw = df[col] if col in df.columns else pd.Series(default, index=df.index)
+        values = pd.to_numeric(raw, errors='coerce')
+        if default is None:
+            invalid = invalid.where(values.notna(), invalid + f"invalid number in '{col}'; ")
+        else:
+            bad = raw.notna() & values.isna()
+            invalid = invalid.where(~bad, invalid + f"invalid number in '{col}'; ")
+            values = values.fillna(default)
+        df[col] = values
+    
+    errors = [f"Row {index}: {message.rstrip('; ')}" for index, message in invalid[invalid != ''].items()]
+    return df[invalid == ''], errors
+
+def iter_sheet_rows(stream, filename):
+    # Yield the header and then each data row of an upload; only legacy .xls is read whole, through pandas
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        try:
+            yield from csv.reader(text)
+        finally:
+            text.detach()
+    elif extension == '.xls':
+        df = pd.read_excel(stream)
+        yield list(df.columns)
+        yield from df.itertuples(index=False, name=None)
+    else:
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        try:
+            yield from workbook.active.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+def iter_import_batches(stream, filename, batch_size):
+    # Group non-blank sheet rows into DataFrames of batch_size rows, indexed by sheet row number (header is row 1)
+    rows = iter_sheet_rows(stream, filename)
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = [str(col).strip() if col is not None else '' for col in header]
+    batch = []
+    row_numbers = []
+    for row_number, row in enumerate(rows, 2):
+        values = [None if value == '' else value for value in row]
+        if all(value is None for value in values):
+            continue
+        batch.append(values[:len(columns)] + [None] * (len(columns) - len(values)))
+        row_numbers.append(row_number)
+        if len(batch) == batch_size:
+            yield pd.DataFrame(batch, columns=columns, index=row_numbers)
+            batch = []
+            row_numbers = []
+    if batch:
+        yield pd.DataFrame(batch, columns=columns, index=row_numbers)
+
+def write_xlsx(headers, rows, title, output=None):
+    # Write rows to output (a temporary file by default) using openpyxl's write-only mode
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=title[:31])
+    sheet.append(headers)
+    for row in rows:
+        sheet.append(tuple(row))
+    if output is None:
+        output = tempfile.TemporaryFile()
+    workbook.save(output)
+    if hasattr(output, 'seek'):
+        output.seek(0)
+    return output
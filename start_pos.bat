@@ -2,6 +2,7 @@
 echo Starting POS System...
 echo.
 echo The application will be available at: http://localhost:5000
+echo Other tills on the network can use this PC's address on port 5000
 echo Default login: admin / admin123
 echo.
 echo Press Ctrl+C to stop the server
@@ -0,0 +1,93 @@
+"""Concurrency stress check for the stock reservation service.
+
+Runs many simultaneous checkouts from several threads against a throwaway
+database and verifies that stock never goes negative, that every unit sold
+is accounted for and that the stock ledger matches. Exits non-zero if any
+invariant breaks.
+
+    python stress_stock.py [--threads 8] [--checkouts 200] [--stock 50]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--checkouts', type=int, default=200, help='checkouts per thread')
+    parser.add_argument('--products', type=int, default=5)
+    parser.add_argument('--stock', type=int, default=50, help='starting stock per product')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp(prefix='pos_stress_')
+    os.environ['POS_DATABASE_URI'] = 'sqlite:///' + os.path.join(db_dir, 'stress.db')
+
+    from app import (app, db, Product, InsufficientStockError, reserve_stock, run_in_transaction,
+                     record_stock_movements, stock_ledger_differences)
+
+    with app.app_context():
+        db.create_all()
+        products = [
+            Product(name=f'Stress {i}', sku=f'STRESS{i}', category='Test', cost_price=1.0,
+                    selling_price=2.0, stock_quantity=args.stock)
+            for i in range(args.products)
+        ]
+        db.session.add_all(products)
+        db.session.flush()
+        product_ids = [p.id for p in products]
+        record_stock_movements({pid: args.stock for pid in product_ids}, 'opening')
+        db.session.commit()
+
+    sold = {pid: 0 for pid in product_ids}
+    counters = {'ok': 0, 'rejected': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def till(seed):
+        rng = random.Random(seed)
+        with app.app_context():
+            for _ in range(args.checkouts):
+                basket = {pid: rng.randint(1, 3) for pid in rng.sample(product_ids, rng.randint(1, len(product_ids)))}
+                try:
+                    run_in_transaction(reserve_stock, basket, 'sale')
+                except InsufficientStockError:
+                    with lock:
+                        counters['rejected'] += 1
+                    continue
+                except Exception as e:
+                    print(f'till {seed}: {e}', file=sys.stderr)
+                    with lock:
+                        counters['errors'] += 1
+                    continue
+                with lock:
+                    counters['ok'] += 1
+                    for pid, qty in basket.items():
+                        sold[pid] += qty
+
+    threads = [threading.Thread(target=till, args=(n,)) for n in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        stock = dict(db.session.query(Product.id, Product.stock_quantity))
+        ledger_differences = stock_ledger_differences()
+        db.engine.dispose()
+    shutil.rmtree(db_dir, ignore_errors=True)
+
+    failed = False
+    for pid in product_ids:
+        balanced = stock[pid] + sold[pid] == args.stock
+        print(f'product {pid}: stock={stock[pid]} sold={sold[pid]} {"ok" if balanced and stock[pid] >= 0 else "MISMATCH"}')
+        failed = failed or stock[pid] < 0 or not balanced
+    for pid, difference in ledger_differences.items():
+        print(f'product {pid}: stock ledger off by {difference:+d}')
+    print(f"checkouts ok={counters['ok']} rejected={counters['rejected']} errors={counters['errors']}")
+    sys.exit(1 if failed or counters['errors'] or ledger_differences else 0)
+
+if __name__ == '__main__':
+    main()